@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
+
+"""Bytes per loaded document, regular vs `__compact__` documents.
+
+Only the containers owned by a document are counted, field values are
+shared between both layouts and left out.
+
+    python -m benchmarks.memory [count]
+"""
+
+
+import sys
+
+from pymongo.objectid import ObjectId
+
+from mongol.document import Document
+from mongol.property import *
+
+
+class Regular(Document):
+    title = StringProperty()
+    body = StringProperty()
+    views = IntegerProperty()
+    rating = FloatProperty()
+    tags = ListProperty()
+    author = DictProperty()
+
+
+class Compact(Document):
+    __compact__ = True
+
+    title = StringProperty()
+    body = StringProperty()
+    views = IntegerProperty()
+    rating = FloatProperty()
+    tags = ListProperty()
+    author = DictProperty()
+
+
+def _sizeof(doc):
+    size = sys.getsizeof(doc)
+    if hasattr(doc, '__dict__'):
+        size += sys.getsizeof(doc.__dict__)
+    cache = getattr(doc, '__documents_cache__', None)
+    if cache is not None:
+        size += sys.getsizeof(cache)
+    if doc.__compact__:
+        size += sys.getsizeof(doc._values)
+        if doc._extra is not None:
+            size += sys.getsizeof(doc._extra)
+    return size
+
+
+def run(count=100000):
+    tags = ['rock', 'roll']
+    author = {'name': 'Slash'}
+    raw = dict(_id=ObjectId(), title=u'Slash rocks', body=u'...', views=10,
+        rating=4.5, tags=tags, author=author)
+
+    for doc_cls in (Regular, Compact):
+        total = sum(_sizeof(doc_cls.from_raw_data(**raw)) for i in xrange(count))
+        print '%-10s %6d bytes/document' % (doc_cls.__name__, total / count)
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:]])
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
+
+"""Validated values per second, one document at a time vs whole columns
+with `Property.validate_column` vs a pool of processes with
+`parallel.validate_many`.
+
+    python -m benchmarks.validation [count]
+"""
+
+
+import sys
+import time
+
+from pymongo.objectid import ObjectId
+
+from mongol.document import Document
+from mongol.parallel import validate_many
+from mongol.property import *
+from mongol.validator import Email, Length, NumberRange
+
+
+class User(Document):
+    name = StringProperty(validators=[Length(min=2, max=40)])
+    email = StringProperty(validators=[Email()])
+    age = IntegerProperty(validators=[NumberRange(min=1, max=150)])
+    score = FloatProperty()
+
+
+def _per_document(docs):
+    for doc in docs:
+        doc._validate_properties()
+
+
+def _per_column(docs):
+    for field in ('_id', 'name', 'email', 'age', 'score'):
+        User.__properties__[field].validate_column([doc[field] for doc in docs])
+
+
+def _per_process(docs):
+    validate_many(docs)
+
+
+def run(count=100000):
+    docs = [User.from_raw_data(_id=ObjectId(), name=u'Slash %d' % i,
+        email=u'slash%d@gnr.com' % i, age=i % 100 + 1, score=i / 3.0)
+        for i in xrange(count)]
+    values = count * 5
+
+    for name, func in (('document', _per_document),
+            ('column', _per_column), ('processes', _per_process)):
+        start = time.time()
+        func(docs)
+        elapsed = time.time() - start
+        print '%-10s %10d values/s' % (name, values / elapsed)
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:]])
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
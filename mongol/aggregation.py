@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
+
+
+from pymongo import ASCENDING
+from pymongo.son import SON
+
+from property import _AttrDict
+
+
+# stages keeping the shape of the documents, after any other stage, e.g.
+# $group, $project, $addFields or $lookup, rows are left as they are
+_SHAPE_PRESERVING_STAGES = ('$match', '$sort', '$skip', '$limit', '$sample',
+    '$redact')
+
+
+class Aggregation(object):
+    """An aggregation pipeline bound to a document class.
+
+    Every builder method returns a new `Aggregation`, the pipeline is only
+    sent to the server when iterating. Field names are checked against the
+    document properties until a stage reshapes the rows, and inherit
+    enabled documents get the `_classes` filter as first `$match` so it
+    can use an index.
+    """
+    def __init__(self, manager, pipeline=None, allow_disk_use=False,
+            as_objects=False):
+        self._manager = manager
+        self._pipeline = []
+        self._reshaped = False
+        self._allow_disk_use = allow_disk_use
+        self._as_objects = as_objects
+        for stage in pipeline or []:
+            self._append(stage)
+
+    def _clone(self):
+        aggregation = Aggregation(self._manager,
+            allow_disk_use=self._allow_disk_use, as_objects=self._as_objects)
+        aggregation._pipeline = list(self._pipeline)
+        aggregation._reshaped = self._reshaped
+        return aggregation
+
+    def _check_expression(self, value):
+        if isinstance(value, basestring) and value.startswith('$'):
+            self._manager._check_field(value[1:])
+        elif isinstance(value, dict):
+            [self._check_expression(v) for v in value.values()]
+        elif isinstance(value, (list, tuple)):
+            [self._check_expression(v) for v in value]
+
+    def _check_spec(self, spec):
+        for k, v in spec.iteritems():
+            if k.startswith('$'):
+                if isinstance(v, (list, tuple)):
+                    [self._check_spec(s) for s in v if isinstance(s, dict)]
+            else:
+                self._manager._check_field(k)
+
+    def _append(self, stage):
+        if not self._reshaped:
+            operator, value = stage.items()[0]
+            if operator == '$match':
+                self._check_spec(value)
+            elif operator == '$sort':
+                [self._manager._check_field(k) for k in value.keys()]
+            else:
+                self._check_expression(value)
+            if operator not in _SHAPE_PRESERVING_STAGES:
+                self._reshaped = True
+        self._pipeline.append(stage)
+
+    def stage(self, stage):
+        """Appends a raw pipeline stage
+        """
+        aggregation = self._clone()
+        aggregation._append(stage)
+        return aggregation
+
+    def match(self, spec):
+        return self.stage({ '$match': spec })
+
+    def project(self, fields):
+        return self.stage({ '$project': fields })
+
+    def group(self, key, **accumulators):
+        fields = { '_id': key }
+        fields.update(accumulators)
+        return self.stage({ '$group': fields })
+
+    def unwind(self, field):
+        if not field.startswith('$'):
+            field = '$' + field
+        return self.stage({ '$unwind': field })
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction)]
+        return self.stage({ '$sort': SON(key_or_list) })
+
+    def skip(self, count):
+        return self.stage({ '$skip': count })
+
+    def limit(self, count):
+        return self.stage({ '$limit': count })
+
+    def allow_disk_use(self, allow=True):
+        aggregation = self._clone()
+        aggregation._allow_disk_use = allow
+        return aggregation
+
+    def as_objects(self, as_objects=True):
+        """Wraps reshaped rows, e.g. `$group` outputs, in lightweight
+        objects with attribute access instead of returning plain dicts.
+        """
+        aggregation = self._clone()
+        aggregation._as_objects = as_objects
+        return aggregation
+
+    @property
+    def pipeline(self):
+        doc_cls = self._manager._document_class
+        pipeline = list(self._pipeline)
+        if doc_cls.__inherit_enabled__:
+            # instance_of() filters of the first $match are kept, narrowed
+            # down like in find
+            if pipeline and pipeline[0].keys() == ['$match']:
+                pipeline[0] = { '$match': self._manager._add_classes_spec(
+                    pipeline[0]['$match']) }
+            else:
+                pipeline.insert(0, { '$match':
+                    self._manager._add_classes_spec({}) })
+        return pipeline
+
+    def _execute(self):
+        kw = {}
+        if self._allow_disk_use:
+            kw['allowDiskUse'] = True
+        result = self._manager.db.command('aggregate',
+            self._manager._collection_name, pipeline=self.pipeline, **kw)
+        return result['result']
+
+    def __iter__(self):
+        from document import _hydrate
+        doc_cls = self._manager._document_class
+        for row in self._execute():
+            if not self._reshaped:
+                yield _hydrate(doc_cls, row)
+            elif self._as_objects:
+                yield _AttrDict(row)
+            else:
+                yield row
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
+
+"""Index audit of captured query shapes.
+
+    mongol audit [-d DATABASE] [--host HOST] [--port PORT] SHAPES
+
+`SHAPES` has one query per line, as JSON in the extended format of
+`pymongo.json_util`, e.g.
+
+    {"document": "blog.models.Post", "spec": {"author": "Slash"}, "sort": [["created", -1]]}
+
+Every query is checked against the indexes its document class declares or
+derives from its properties. With a database the queries are replayed with
+`explain` too, reporting the index the server used and the documents
+examined and returned. Exits with 1 if a query has no supporting index.
+"""
+
+
+import sys
+import json
+from optparse import OptionParser
+
+from pymongo import json_util
+
+from connection import connect
+from explain import supporting_index
+
+
+def _load_class(path):
+    module_name, class_name = path.replace(':', '.').rsplit('.', 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+def _format_keys(keys):
+    return ', '.join('%s %s' % (k, direction) for k, direction in keys)
+
+
+def audit(lines, replay=False, out=sys.stdout):
+    """Checks the query shapes in `lines`, returns the number of queries
+    without a supporting index
+    """
+    missing = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        shape = json.loads(line, object_hook=json_util.object_hook)
+        doc_cls = _load_class(shape['document'])
+        spec = shape.get('spec') or {}
+        sort = [tuple(s) for s in shape.get('sort') or []]
+
+        print >> out, '%s.find(%s)%s' % (doc_cls.__class_name__,
+            json.dumps(spec, default=json_util.default),
+            sort and '.sort(%s)' % _format_keys(sort) or '')
+        keys = supporting_index(doc_cls, spec, sort)
+        if keys is None:
+            missing += 1
+            print >> out, '    no supporting index'
+        elif keys:
+            print >> out, '    index: %s' % _format_keys(keys)
+
+        if replay:
+            cursor = doc_cls.m.find(spec)
+            if sort:
+                cursor.sort(sort)
+            summary = cursor.explain_summary()
+            print >> out, '    plan: %s, examined %s, returned %s, %s ms' % (
+                summary['index'] or 'collection scan', summary['examined'],
+                summary['returned'], summary['millis'])
+    return missing
+
+
+def main(argv=None):
+    parser = OptionParser(prog='mongol', usage='%prog audit [options] SHAPES')
+    parser.add_option('-d', '--database', dest='database',
+        help='replay the queries with explain on DATABASE')
+    parser.add_option('--host', dest='host', default='localhost')
+    parser.add_option('--port', dest='port', type='int', default=27017)
+    options, args = parser.parse_args(argv)
+    if len(args) != 2 or args[0] != 'audit':
+        parser.error('expected: audit SHAPES')
+
+    if options.database:
+        connect(options.database, host=options.host, port=options.port)
+    f = open(args[1])
+    try:
+        missing = audit(f, replay=bool(options.database))
+    finally:
+        f.close()
+    return missing and 1 or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -3,15 +3,33 @@
 # Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
 
 
+import json
 import logging
-from copy import deepcopy
+import threading
+from copy import copy, deepcopy
+from datetime import datetime
+from itertools import islice
+from UserDict import DictMixin
 
+from pymongo import ASCENDING, DESCENDING, GEO2D
 from pymongo.dbref import DBRef
+from pymongo.errors import CollectionInvalid, OperationFailure
+from pymongo.objectid import ObjectId
+from pymongo.son import SON
 
 from connection import get_db
 from property import Property, ObjectIdProperty, ReferenceProperty
-from property import EmbedDocumentProperty
+from property import EmbedDocumentProperty, DateTimeProperty, GeoPtProperty
+from property import BinaryProperty, FileProperty, _EmbedDocumentList
+from property import DictProperty, ListProperty
+from property import _WINDOWS, _list_windows
 from validator import ValidationError
+from aggregation import Aggregation
+from explain import summarize_plan
+from query import Query
+from watch import watch, tail
+from writebehind import write_behind_queue
+from parallel import _validate_rows
 
 
 class DocumentNotSavedError(Exception):
@@ -22,38 +40,217 @@ class DocumentInheritError(Exception):
     pass
 
 
+class DocumentDefinitionError(Exception):
+    pass
+
+
+# guards the changed fields and the documents cache against the write
+# behind threads reporting written and failed rows
+_state_lock = threading.RLock()
+
+
+# getLastError options, any of them makes pymongo wait for the write
+_WRITE_CONCERN_OPTIONS = ('w', 'wtimeout', 'j', 'fsync')
+
+# index key directions pymongo's ensure_index accepts
+_DRIVER_DIRECTIONS = (ASCENDING, DESCENDING, GEO2D)
+
+_UPDATE_OPERATORS = (
+    ('set', '$set'),
+    ('unset', '$unset'),
+    ('inc', '$inc'),
+    ('push', '$push'),
+    ('add_to_set', '$addToSet'),
+    ('pull', '$pull'),
+)
+
+
 class CollectionManager(object):
     def __init__(self, collection_name, doc_cls):
         self._collection_name = collection_name
         self._document_class = doc_cls
         self._db = None
+        self._indexes_ensured = False
 
     def _wrap_arguments(self, *args, **kw):
         if self._document_class.__inherit_enabled__:
-            extra_spec = { '_classes': self._document_class.__class_name__ }
             if args:
-                args[0].update(extra_spec)
+                args = (self._add_classes_spec(args[0]), ) + args[1:]
             else:
-                if 'spec' in kw.keys():
-                    kw['spec'].update(extra_spec)
-                else:
-                    kw['spec'] = extra_spec
+                kw['spec'] = self._add_classes_spec(kw.get('spec'))
         return args, kw
 
-    def all(self):
-        args, kw = self._wrap_arguments(spec={})
-        return CursorProxy(self._document_class, self.collection.find(*args, **kw))
+    def _read_options(self, kw):
+        # the read preference of the document class, or of the call
+        preference = kw.pop('read_preference',
+            self._document_class.__read_preference__)
+        if preference != 'primary':
+            kw.setdefault('slave_okay', True)
+        return kw
+
+    def _write_options(self, kw):
+        # the write concern of the document class, overridden by the call
+        options = dict(self._document_class.__write_concern__ or {})
+        options.update(kw)
+        if options.get('w') == 0:
+            # fire and forget
+            options = dict((k, v) for k, v in options.iteritems()
+                if k not in _WRITE_CONCERN_OPTIONS)
+            options['safe'] = False
+        return options
+
+    def _add_classes_spec(self, spec):
+        # the spec of the caller is left untouched, it may be used again
+        doc_cls = self._document_class
+        if spec is None:
+            spec = {}
+        elif isinstance(spec, dict):
+            spec = dict(spec)
+        else:
+            spec = { '_id': spec }
+        classes = spec.get('_classes')
+        if isinstance(classes, dict) and '$in' in classes:
+            # an instance_of() filter, narrowed down to this class: all of
+            # it if this class or an ancestor is listed, else the sub
+            # classes listed
+            listed = classes['$in']
+            if doc_cls.__class_name__ in listed or \
+                    [c for c in listed if c in doc_cls.__super_classes__]:
+                spec['_classes'] = doc_cls.__class_name__
+            else:
+                spec['_classes'] = { '$in': [c for c in listed
+                    if c in doc_cls.__sub_classes__] }
+        else:
+            spec['_classes'] = doc_cls.__class_name__
+        return spec
+
+    def _windows(self, args, kw):
+        fields = kw.get('fields', len(args) > 1 and args[1] or None)
+        return _list_windows(self._document_class, fields)
+
+    def all(self, **kw):
+        args, kw = self._wrap_arguments(spec={}, **kw)
+        kw = self._read_options(kw)
+        return CursorProxy(self._document_class, self.collection.find(*args, **kw),
+            self._windows(args, kw))
 
     def find(self, *args, **kw):
         args, kw = self._wrap_arguments(*args, **kw)
-        return CursorProxy(self._document_class, self.collection.find(*args, **kw))
+        kw = self._read_options(kw)
+        return CursorProxy(self._document_class, self.collection.find(*args, **kw),
+            self._windows(args, kw))
+
+    def filter(self, *conditions, **fields):
+        """Returns a lazily executed `Query`, e.g.
+
+            Blog.m.filter(Blog.title == 'x', Blog.views > 10).order_by('-created')
+        """
+        return Query(self).filter(*conditions, **fields)
+
+    def resolve_references(self, documents, *fields):
+        """Loads the referenced documents of all `documents` at once, with
+        one `$in` query per referenced collection. All reference properties
+        are resolved unless `fields` are given, e.g.
+
+            posts = list(Post.m.find())
+            Post.m.resolve_references(posts, 'author', 'tags')
+        """
+        pending = []
+        ids_by_collection = {}
+        for doc in documents:
+            for field in fields or doc.__referenced_documents__.keys():
+                prop = doc.__referenced_documents__[field]
+                ids = prop._pending_ids(doc)
+                if ids is None:
+                    continue
+                pending.append((doc, prop, ids))
+                ref_cls = prop._reference_class
+                ids_by_collection.setdefault(ref_cls.__collection_name__,
+                    (ref_cls, set()))[1].update(ids)
+
+        rows = {}
+        for collection_name, (ref_cls, ids) in ids_by_collection.iteritems():
+            if not ids:
+                continue
+            for row in ref_cls.m.collection.find({ '_id': { '$in': list(ids) } },
+                    **ref_cls.m._read_options({})):
+                rows[(collection_name, row['_id'])] = row
+
+        # documents referenced more than once are shared
+        resolved = {}
+        for doc, prop, ids in pending:
+            ref_cls = prop._reference_class
+            docs = []
+            for _id in ids:
+                key = (ref_cls, _id)
+                if key not in resolved:
+                    row = rows.get((ref_cls.__collection_name__, _id))
+                    resolved[key] = row and _hydrate(ref_cls, row)
+                docs.append(resolved[key])
+            prop._resolved(doc, docs)
+
+    def _check_datetime_field(self, field):
+        if not isinstance(self._check_field(field), DateTimeProperty):
+            raise ValidationError('%s is not a datetime property of %s' % (field,
+                self._document_class.__class_name__))
+
+    def find_in_range(self, field, start, end, spec=None, **kw):
+        """Finds the documents whose datetime `field` is in [start, end)
+        """
+        self._check_datetime_field(field)
+        spec = dict(spec or {})
+        spec[field] = { '$gte': start, '$lt': end }
+        return self.find(spec, **kw)
+
+    def time_buckets(self, field, start, end, size, spec=None, **kw):
+        """Splits [start, end) into buckets of the timedelta `size` and
+        yields `(bucket_start, cursor)` for each of them, so large time
+        ranges are walked in small index range scans.
+        """
+        self._check_datetime_field(field)
+        bucket_start = start
+        while bucket_start < end:
+            bucket_end = min(bucket_start + size, end)
+            yield bucket_start, self.find_in_range(field, bucket_start,
+                bucket_end, spec=spec, **kw)
+            bucket_start = bucket_end
+
+    def _geo_property(self, field):
+        prop = self._check_field(field)
+        if not isinstance(prop, GeoPtProperty):
+            raise ValidationError('%s is not a geo property of %s' % (field,
+                self._document_class.__class_name__))
+        return prop
+
+    def _geo_find(self, field, geo_spec, spec, **kw):
+        spec = dict(spec or {})
+        spec[field] = geo_spec
+        return self.find(spec, **kw)
+
+    def near(self, field, point, max_distance=None, limit=None, spec=None, **kw):
+        """Finds the documents nearest to `point`, sorted by distance
+        """
+        prop = self._geo_property(field)
+        if limit is not None:
+            kw['limit'] = limit
+        return self._geo_find(field, prop.near_spec(point, max_distance), spec, **kw)
+
+    def within_box(self, field, bottom_left, top_right, spec=None, **kw):
+        prop = self._geo_property(field)
+        return self._geo_find(field, prop.within_box_spec(bottom_left, top_right),
+            spec, **kw)
+
+    def within_polygon(self, field, points, spec=None, **kw):
+        prop = self._geo_property(field)
+        return self._geo_find(field, prop.within_polygon_spec(points), spec, **kw)
 
     def find_one(self, *args, **kw):
         args, kw = self._wrap_arguments(*args, **kw)
+        kw = self._read_options(kw)
         result = self.collection.find_one(*args, **kw)
         if not result:
             return None
-        return self._document_class(**result)
+        return _hydrate(self._document_class, result, self._windows(args, kw))
 
     @property
     def db(self):
@@ -65,36 +262,327 @@ class CollectionManager(object):
     def collection(self):
         return self.db[self._collection_name]
 
+    def ensure_collection(self):
+        """Creates the collection with the `__collection_options__` of the
+        document class, e.g.
+
+            class Event(Document):
+                __collection_options__ = { 'capped': True, 'size': 10 ** 8 }
+
+        Done on the first write anyway. Returns True if the collection was
+        created, existing collections are left as they are.
+        """
+        options = self._document_class.__collection_options__
+        if options and self._collection_name not in self.db.collection_names():
+            try:
+                self.db.create_collection(self._collection_name, **options)
+                return True
+            except CollectionInvalid:
+                # created meanwhile, e.g. by another process
+                pass
+            except OperationFailure, e:
+                if 'already exists' not in str(e):
+                    raise
+        if options.get('capped') and not self.collection.options().get('capped'):
+            logging.warning('Collection %s exists already and is not capped',
+                self._collection_name)
+        return False
+
+    def ensure_indexes(self):
+        """Creates the indexes declared in `__indexes__` and the ones the
+        properties need, e.g. TTL indexes. Done on the first write anyway.
+        """
+        for keys, options in self._document_class.__indexes__:
+            if [d for k, d in keys if d not in _DRIVER_DIRECTIONS]:
+                self._create_index(keys, options)
+            else:
+                self.collection.ensure_index(keys, **options)
+        self._indexes_ensured = True
+
+    def _create_index(self, keys, options):
+        # pymongo only takes ASCENDING, DESCENDING and GEO2D keys, others
+        # like 2dsphere are inserted into system.indexes the way it does
+        index = dict(options)
+        index['key'] = SON(keys)
+        index['ns'] = self.collection.full_name
+        index.setdefault('name', u'_'.join([u'%s_%s' % k for k in keys]))
+        self.db.system.indexes.insert(index, manipulate=False, check_keys=False,
+            safe=True)
+
+    def watch(self, spec=None, fields=None, resume_after=None, resume_name=None,
+            poll_interval=1):
+        """Returns a generator of `ChangeEvent`s for the documents of this
+        class, read by tailing the oplog, so it needs a replica set, e.g.
+
+            for event in Blog.m.watch(resume_name='blog-cache'):
+                cache.invalidate(event.document_id)
+
+        Inserted and updated documents are loaded with `spec` and `fields`,
+        changes of documents not matching `spec` are skipped. Deletes are
+        always reported, without a document.
+
+        Watching starts now, after the `token` of an event given as
+        `resume_after`, or with `resume_name` after the last event handled
+        by the watch of that name, its token is stored in the database.
+        """
+        return watch(self, spec, fields, resume_after=resume_after,
+            resume_name=resume_name, poll_interval=poll_interval)
+
+    def tail(self, spec=None, fields=None, resume_after=None, poll_interval=1):
+        """Returns a generator of the documents of a capped collection in
+        insertion order, waiting for new documents at the end. Pass the
+        `_id` of the last document handled as `resume_after` to go on from
+        there.
+        """
+        return tail(self, spec, fields, resume_after=resume_after,
+            poll_interval=poll_interval)
+
+    def estimated_count(self):
+        """Returns the number of documents in the collection from its
+        metadata, without a query. Inherit enabled documents share their
+        collection, all classes are counted.
+        """
+        return self.collection.count()
+
+    def approximate_count(self, spec=None, max_time_ms=1000):
+        """Counts the documents matching `spec`, giving up after
+        `max_time_ms` milliseconds on the server. The collection total of
+        `estimated_count` is returned then, an upper bound of the count.
+        """
+        args, kw = self._wrap_arguments(spec or {})
+        try:
+            result = self.db.command('count', self._collection_name,
+                query=args[0], maxTimeMS=max_time_ms)
+        except OperationFailure, e:
+            if 'exceeded time limit' not in str(e):
+                raise
+            return self.estimated_count()
+        return int(result['n'])
+
+    def remove(self, spec_or_id=None, **kwargs):
+        return self.collection.remove(spec_or_id, **self._write_options(kwargs))
+
+    def drop(self):
+        self._indexes_ensured = False
+        self.collection.drop()
+
+    def _prepare_writes(self):
+        if not self._indexes_ensured:
+            self.ensure_collection()
+            self.ensure_indexes()
+
     def save(self, doc, **kwargs):
-        _id = self.collection.save(doc, **kwargs)
+        self._prepare_writes()
+        _id = self.collection.save(doc._mongo_data(), **self._write_options(kwargs))
         doc._id = _id
 
+    def insert_many(self, docs, **kwargs):
+        """Inserts new documents with a single bulk insert
+        """
+        self._prepare_writes()
+        ids = self.collection.insert([doc._mongo_data() for doc in docs],
+            **self._write_options(kwargs))
+        for doc, _id in zip(docs, ids):
+            doc._set_raw('_id', _id)
+        return ids
+
+    def _check_field(self, field):
+        """Returns the property a (dotted) field name belongs to, raises a
+        ValidationError for unknown fields of not expandable documents.
+        """
+        name = field.split('.')[0]
+        prop = self._document_class.__properties__.get(name)
+        if prop is None and name not in ('_classes', '_class_name') and \
+                not self._document_class.__expandable__:
+            raise ValidationError('%s is not a property of %s' % (name,
+                self._document_class.__class_name__))
+        return prop
+
+    def _update_operand(self, operator, field, value):
+        prop = self._check_field(field)
+        if prop is None or '.' in field:
+            return value
+
+        prop.validate_operand(operator, value)
+        return prop.get_operand_for_mongo(operator, value)
+
+    def _convert_update(self, update):
+        document = {}
+        for key, value in update.iteritems():
+            if key.startswith('$'):
+                document[key] = dict((k, self._update_operand(key, k, v))
+                    for k, v in value.iteritems())
+            else:
+                # a replacement document
+                document[key] = self._update_operand('$set', key, value)
+        return document
+
+    def _build_update(self, operations):
+        document = dict((operator, operations[name])
+            for name, operator in _UPDATE_OPERATORS if operations.get(name))
+        if not document:
+            raise ValueError('No update operations given')
+        return self._convert_update(document)
+
+    def update_one(self, spec, set=None, unset=None, inc=None, push=None,
+            add_to_set=None, pull=None, **kwargs):
+        """Atomically updates the first document matching `spec`.
+
+        The operands are validated against the properties and converted
+        with `get_value_for_mongo`, e.g.
+
+            Blog.m.update_one({'title': 'x'}, set={'body': 'y'}, inc={'views': 1})
+        """
+        document = self._build_update(dict(set=set, unset=unset, inc=inc,
+            push=push, add_to_set=add_to_set, pull=pull))
+        args, kw = self._wrap_arguments(spec)
+        if kwargs.get('upsert'):
+            # may create the collection, like save() does
+            self._prepare_writes()
+        return self.collection.update(args[0], document,
+            **self._write_options(kwargs))
+
+    def aggregate(self, pipeline=None, allow_disk_use=False):
+        """Returns an `Aggregation` pipeline builder bound to the document
+        class, e.g.
+
+            Blog.m.aggregate().match({'author': 'Slash'}).group('$author',
+                views={'$sum': '$views'}).sort('views', DESCENDING)
+        """
+        return Aggregation(self, pipeline, allow_disk_use=allow_disk_use)
+
+    def find_one_and_update(self, spec, update, upsert=False, return_new=False, **kwargs):
+        """Atomically updates the first document matching `spec` and returns
+        it as a document instance in one round trip, e.g. to claim a job
+
+            job = Job.m.find_one_and_update({'state': 'new'},
+                {'$set': {'state': 'running'}}, return_new=True)
+
+        The document is returned as it was before the update unless
+        `return_new` is set. Returns None if nothing matched. Extra keyword
+        arguments like `sort` and `fields` go to `find_and_modify`.
+        """
+        document = self._convert_update(update)
+        if upsert and self._document_class.__inherit_enabled__:
+            class_fields = self._document_class._class_fields()
+            if [k for k in document.keys() if k.startswith('$')]:
+                document.setdefault('$set', {}).update(class_fields)
+            else:
+                document.update(class_fields)
+        args, kw = self._wrap_arguments(spec)
+        if upsert:
+            self._prepare_writes()
+        result = self.collection.find_and_modify(args[0], document,
+            upsert=upsert, new=return_new, **kwargs)
+        if not result:
+            return None
+        return _hydrate(self._document_class, result, self._windows((), kwargs))
+
+    def update_many(self, spec, set=None, unset=None, inc=None, push=None,
+            add_to_set=None, pull=None, **kwargs):
+        """Same as `update_one`, but updates all matching documents.
+        """
+        kwargs['multi'] = True
+        return self.update_one(spec, set=set, unset=unset, inc=inc, push=push,
+            add_to_set=add_to_set, pull=pull, **kwargs)
+
     def __getattr__(self, name):
         return getattr(self.collection, name)
 
 
+def _loads_raw(doc_cls):
+    # documents not customizing how they are loaded are filled from a
+    # decoded row directly
+    return not doc_cls.__embedded__ and \
+        doc_cls.__init__.im_func is Document.__init__.im_func and \
+        doc_cls.from_raw_data.im_func is Document.from_raw_data.im_func
+
+
+def _class_of(doc_cls, result):
+    if doc_cls.__inherit_enabled__:
+        return doc_cls.__class_registry__.get(result.get('_class_name'), doc_cls)
+    return doc_cls
+
+
+def _hydrate(doc_cls, result, windows=None):
+    doc_cls = _class_of(doc_cls, result)
+    if doc_cls.__loads_raw__:
+        # one copy of the decoded row, no keyword arguments and no __init__
+        doc = dict.__new__(doc_cls)
+        if doc_cls.__compact__:
+            _CompactStorage.__init__(doc, result)
+        else:
+            dict.update(doc, result)
+        doc._init_state()
+    else:
+        doc = doc_cls.from_raw_data(**result)
+        doc._clear_changed()
+    if windows:
+        # lists loaded partly, see EmbedDocumentListProperty.slice
+        doc.__documents_cache__[_WINDOWS] = windows
+    return doc
+
+
+def _json_default(value):
+    # values nested in dicts and lists, not converted by a property
+    if isinstance(value, ObjectId):
+        return unicode(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, DBRef):
+        return unicode(value.id)
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def _json_reference(doc, expand):
+    if doc is None:
+        return None
+    if expand:
+        return doc._json_data()
+    return doc._id and unicode(doc._id)
+
+
+def instance_of(*classes):
+    """Returns a spec matching documents of any of the given classes of an
+    inherit enabled hierarchy, including their sub classes, e.g.
+
+        Shape.m.find(instance_of(Rectangle, Circle))
+    """
+    registries = set(id(c.__class_registry__) for c in classes)
+    if not classes or len(registries) != 1 or not classes[0].__inherit_enabled__:
+        raise DocumentInheritError("Classes must belong to one inherit enabled hierarchy")
+    return { '_classes': { '$in': [c.__class_name__ for c in classes] } }
+
+
 class CursorProxy(object):
-    def __init__(self, doc_cls, pymongo_cursor):
+    def __init__(self, doc_cls, pymongo_cursor, windows=None):
         self._doc_cls = doc_cls
         self._pymongo_cursor = pymongo_cursor
+        self._windows = windows
+        # len() is counted once, until skip or limit change
+        self._count = None
 
     def next(self):
         result = self._pymongo_cursor.next()
         return self._wrap_result(result)
 
     def _wrap_result(self, result):
-        if self._doc_cls.__inherit_enabled__:
-            class_name = result.get('_class_name')
-            if class_name in self._doc_cls.__super_classes__:
-                return self._doc_cls.__super_classes__[class_name].from_raw_data(**result)
-            elif class_name in self._doc_cls.__sub_classes__:
-                return self._doc_cls.__sub_classes__[class_name].from_raw_data(**result)
-        return self._doc_cls.from_raw_data(**result)
+        return _hydrate(self._doc_cls, result, self._windows)
 
     def sort(self, *args, **kwargs):
         self._pymongo_cursor.sort(*args, **kwargs)
         return self
 
+    def skip(self, skip):
+        self._pymongo_cursor.skip(skip)
+        self._count = None
+        return self
+
+    def limit(self, limit):
+        self._pymongo_cursor.limit(limit)
+        self._count = None
+        return self
+
     def __getattr__(self, name):
         return getattr(self._pymongo_cursor, name)
 
@@ -102,12 +590,57 @@ class CursorProxy(object):
         result = self._pymongo_cursor.__getitem__(index)
 
         if isinstance(index, slice):
+            self._count = None
             return self
         else:
             return self._wrap_result(result)
 
     def __len__(self):
-        return self._pymongo_cursor.count(with_limit_and_skip=True)
+        if self._count is None:
+            self._count = self._pymongo_cursor.count(with_limit_and_skip=True)
+        return self._count
+
+    def explain_summary(self):
+        """Returns a summary of the query plan, e.g.
+
+            {'index': 'title_1', 'collection_scan': False, 'examined': 12,
+             'returned': 10, 'millis': 0}
+        """
+        return summarize_plan(self._pymongo_cursor.explain())
+
+    def validate(self, processes=None, chunk_size=500):
+        """Validates the results on a pool of worker processes, without
+        loading them as documents here, see `parallel.validate_many`.
+        Returns the `_id`s of the invalid documents with their
+        ValidationError.
+        """
+        doc_cls = self._doc_cls
+        rows = [(_class_of(doc_cls, row), row) for row in self._pymongo_cursor]
+        return [(rows[i][1].get('_id'), ValidationError(message))
+            for i, message in _validate_rows(rows, processes, chunk_size)]
+
+    def to_json_stream(self, fields=None, expand=(), chunk_size=100):
+        """Yields the results as one JSON array, in chunks of `chunk_size`
+        documents. Without `expand` the decoded rows are serialized as they
+        are, otherwise the references of each chunk are loaded at once.
+        """
+        doc_cls = self._doc_cls
+        separator = '['
+        while True:
+            rows = list(islice(self._pymongo_cursor, chunk_size))
+            if not rows:
+                break
+            if expand:
+                docs = [_hydrate(doc_cls, row) for row in rows]
+                doc_cls.m.resolve_references(docs, *expand)
+                data = [doc._json_data(fields, expand) for doc in docs]
+            else:
+                data = [_class_of(doc_cls, row)._json_fields(row, fields)
+                    for row in rows]
+            yield separator + ', '.join(json.dumps(d, default=_json_default)
+                for d in data)
+            separator = ', '
+        yield separator == '[' and '[]' or ']'
 
     def __iter__(self):
         return self
@@ -134,6 +667,210 @@ def _digg_bases(properties, super_classes, base):
                 super_classes.update(base.__super_classes__)
 
 
+class _PropertyOverlay(DictMixin):
+    """Per-instance view over the class-level `__properties__`.
+
+    Properties installed on an expandable document are kept in a small
+    instance dict in front of the shared class dict, so instances never
+    mutate the class descriptors.
+    """
+    def __init__(self, properties):
+        self._properties = properties
+        self._dynamic = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._dynamic[key]
+        except KeyError:
+            return self._properties[key]
+
+    def __setitem__(self, key, value):
+        self._dynamic[key] = value
+
+    def __delitem__(self, key):
+        del self._dynamic[key]
+
+    def __contains__(self, key):
+        return key in self._dynamic or key in self._properties
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self._properties.keys() + [k for k in self._dynamic.keys()
+            if k not in self._properties]
+
+
+_MISSING = object()
+
+
+class _CompactStorage(dict):
+    """Storage for `__compact__` documents.
+
+    Values of declared properties are kept in a list laid out by the
+    class `__property_order__`, other keys go into an overflow dict that
+    is only created when needed. The dict interface is emulated on top of
+    it, the underlying dict itself stays empty: C level consumers like
+    `dict(doc)`, `json.dumps(doc)` and `**doc` see no keys, use
+    `Document.to_dict()` for them.
+    """
+    __slots__ = ('_values', '_extra')
+
+    def __init__(self, *args, **kw):
+        object.__setattr__(self, '_values', [_MISSING] * len(self.__property_order__))
+        object.__setattr__(self, '_extra', None)
+        _CompactStorage.update(self, *args, **kw)
+
+    def __getitem__(self, key):
+        index = self.__slot_index__.get(key)
+        if index is not None:
+            value = self._values[index]
+            if value is not _MISSING:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        index = self.__slot_index__.get(key)
+        if index is not None:
+            self._values[index] = value
+        else:
+            if self._extra is None:
+                object.__setattr__(self, '_extra', {})
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        index = self.__slot_index__.get(key)
+        if index is not None:
+            if self._values[index] is _MISSING:
+                raise KeyError(key)
+            self._values[index] = _MISSING
+        elif self._extra is not None:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        # the raw storage, Document.__getitem__ falls back to defaults
+        try:
+            _CompactStorage.__getitem__(self, key)
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def iteritems(self):
+        for k, v in zip(self.__property_order__, self._values):
+            if v is not _MISSING:
+                yield (k, v)
+        if self._extra:
+            for item in self._extra.iteritems():
+                yield item
+
+    def iterkeys(self):
+        for k, v in self.iteritems():
+            yield k
+
+    def itervalues(self):
+        for k, v in self.iteritems():
+            yield v
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def get(self, key, default=None):
+        try:
+            return _CompactStorage.__getitem__(self, key)
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        try:
+            return _CompactStorage.__getitem__(self, key)
+        except KeyError:
+            _CompactStorage.__setitem__(self, key, default)
+            return default
+
+    def pop(self, key, *args):
+        try:
+            value = _CompactStorage.__getitem__(self, key)
+        except KeyError:
+            if args:
+                return args[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, *args, **kw):
+        # stored as given, like dict.update does for other documents
+        set_item = _CompactStorage.__setitem__
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                for k in other.keys():
+                    set_item(self, k, other[k])
+            else:
+                for k, v in other:
+                    set_item(self, k, v)
+        for k, v in kw.iteritems():
+            set_item(self, k, v)
+
+    def clear(self):
+        object.__setattr__(self, '_values', [_MISSING] * len(self._values))
+        object.__setattr__(self, '_extra', None)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __reduce_ex__(self, protocol):
+        # the slots are empty until __init__, so copies and pickles are
+        # loaded again from the stored values
+        return (_hydrate, (self.__class__, self.to_dict()))
+
+
+class _EmbedStorage(dict):
+    """Storage for embed documents, the values are kept in the dict itself.
+
+    An embed document loaded with its parent takes the place of the sub
+    dict stored in the parent, so writes end up in the parent and the
+    parent is encoded with the document's values.
+    """
+    __slots__ = ('_parent', '_parent_field')
+
+    @property
+    def _data(self):
+        # the dict stored in the parent
+        return self
+
+    def __reduce_ex__(self, protocol):
+        # copied and pickled with the stored values, detached from the parent
+        return (_load_embed, (self.__class__, dict(self)))
+
+
+def _load_embed(cls, data):
+    return cls._view(data)
+
+
 def _digg_required_or_unique_properties(properties):
     required_properties = {}
     unique_properties = {}
@@ -172,6 +909,10 @@ class DocumentMeta(type):
 
         collection_name = None
         inherit_enabled = False
+        compact = attrs.get('__compact__',
+            any(getattr(b, '__compact__', False) for b in bases))
+        # sub classes of EmbedDocument, not EmbedDocument itself
+        embedded = any(getattr(b, '__embedded__', False) for b in bases)
 
         for b in bases:
             if hasattr(b, '__collection_name__'):
@@ -192,30 +933,98 @@ class DocumentMeta(type):
         super_classes = {}
         [_digg_bases(properties, super_classes, b) for b in bases]
 
-        for name, attr in attrs.iteritems():
+        for attr_name, attr in attrs.iteritems():
             if isinstance(attr, Property):
-                properties[name] = attr
+                properties[attr_name] = attr
+
+        if '_id' not in properties:
+            # a class attribute too, for conditions like `Blog._id == id`
+            properties['_id'] = attrs['_id'] = ObjectIdProperty()
 
         attrs['__properties__'] = properties
         attrs['__required_properties__'], attrs['__unique_properties__'] = _digg_required_or_unique_properties(properties)
         attrs['__super_classes__'] = super_classes
         attrs['__sub_classes__'] = {}
         attrs['__referenced_documents__'], attrs['__embed_documents__'] = _digg_referenced_and_embed_docs(properties)
+        attrs['__file_properties__'] = dict((k, v) for k, v in properties.iteritems()
+            if isinstance(v, FileProperty))
+        attrs['__binary_properties__'] = dict((k, v) for k, v in properties.iteritems()
+            if isinstance(v, BinaryProperty))
+        # properties converting the values given to the constructor
+        attrs['__converted_properties__'] = dict((k, v) for k, v in properties.iteritems()
+            if isinstance(v, (BinaryProperty, GeoPtProperty)))
+        # values changed in place through their wrappers go unnoticed
+        attrs['__container_properties__'] = tuple(k for k, v in properties.iteritems()
+            if isinstance(v, (DictProperty, ListProperty)))
+        # compact embed documents at any depth, they are converted on writes
+        attrs['__compact_embeds__'] = any(p._embed_class.__compact__ or
+            p._embed_class.__compact_embeds__
+            for p in attrs['__embed_documents__'].values())
+        attrs['__property_order__'] = tuple(sorted(properties.keys()))
+        attrs['__slot_index__'] = dict((k, i) for i, k in enumerate(attrs['__property_order__']))
+        attrs['__auto_now__'] = tuple(k for k, v in properties.iteritems()
+            if getattr(v, 'auto_now', False))
+        attrs['__auto_now_add__'] = tuple(k for k, v in properties.iteritems()
+            if getattr(v, 'auto_now_add', False))
+        if '__indexes__' in attrs:
+            attrs['__declared_indexes__'] = attrs.pop('__indexes__')
 
         if super_classes:
             if not inherit_enabled:
                 raise DocumentInheritError("Document class inherit not enabled")
 
+        options = attrs.get('__collection_options__') or {}
+        if options.get('capped') and not options.get('size'):
+            raise DocumentDefinitionError("Capped collection needs a size")
+
+        if compact:
+            if attrs.get('__expandable__', any(getattr(b, '__expandable__', False) for b in bases)):
+                raise DocumentDefinitionError("Compact document can not be expandable")
+            attrs['__compact__'] = True
+            if not [b for b in bases if issubclass(b, _CompactStorage)]:
+                bases = bases + (_CompactStorage, )
+                slots = ('__documents_cache__', '__changed_fields__')
+                if embedded:
+                    slots += ('_parent', '_parent_field')
+                attrs.setdefault('__slots__', slots)
+            else:
+                attrs.setdefault('__slots__', ())
+        elif embedded:
+            if not [b for b in bases if issubclass(b, _EmbedStorage)]:
+                bases = bases + (_EmbedStorage, )
+
         new_cls = super_new(cls, name, bases, attrs)
         collection_manager = CollectionManager(collection_name, new_cls)
         setattr(new_cls, '__collection_manager__', collection_manager)
         setattr(new_cls, 'm', collection_manager)
         if hasattr(new_cls, '__properties__'):
-            for name, prop in new_cls.__properties__.iteritems():
-                prop.attach(new_cls, name)
+            for prop_name, prop in new_cls.__properties__.iteritems():
+                prop.attach(new_cls, prop_name)
+
+        # declared indexes are either a list of keys or (keys, options)
+        indexes = []
+        for index in getattr(new_cls, '__declared_indexes__', []):
+            if isinstance(index, tuple):
+                indexes.append(index)
+            else:
+                indexes.append((index, {}))
+        for prop in new_cls.__properties__.values():
+            indexes.extend(prop.indexes())
+        new_cls.__indexes__ = indexes
+        new_cls.__loads_raw__ = _loads_raw(new_cls)
 
         [_bind_to_superclasses(s, new_cls) for s in super_classes.values()]
 
+        # one registry per hierarchy, resolving a _class_name at any depth
+        registries = [b.__class_registry__ for b in bases
+            if getattr(b, '__class_registry__', None) is not None]
+        if super_classes and registries:
+            registry = registries[0]
+        else:
+            registry = {}
+        registry[new_cls.__class_name__] = new_cls
+        new_cls.__class_registry__ = registry
+
         return new_cls
 
     def __init__(cls, name, bases, attrs):
@@ -227,58 +1036,135 @@ class DocumentMeta(type):
 
 class Document(dict):
     __metaclass__ = DocumentMeta
+    __slots__ = ()
     # __collection_name__ = "collection_name"
     __inherit_enabled__ = False
     __expandable__ = False
+    # True to keep property values in slots, to_dict() gives a plain dict
+    __compact__ = False
+    __embedded__ = False
+    __changed_fields__ = None
+    __loads_raw__ = False
+    # options the collection is created with, see ensure_collection
+    __collection_options__ = {}
+    # getLastError options of writes, e.g. { 'w': 'majority' } or
+    # { 'w': 0 } not to wait at all, can be given per call too
+    __write_concern__ = None
+    # 'primary', or any other preference to let reads go to secondaries
+    __read_preference__ = 'primary'
+    # True, or a WriteBehindQueue, to write saved documents in the background
+    __write_behind__ = False
 
     # def __new__(cls, *args, **kw):
         # return dict.__new__(cls, *args, **kw)
 
     def __init__(self, *args, **kw):
-        self.__dict__['__documents_cache__'] = dict()
+        self._init_state()
 
         # the initial value of referenced documents only stored in cache
         for k in self.__referenced_documents__.keys():
-            if k in kw.keys():
-                v = kw.pop(k)
-                self.__documents_cache__[k] = v
+            v = kw.get(k)
+            if isinstance(v, Document) or (isinstance(v, list) and
+                    [d for d in v if isinstance(d, Document)]):
+                self.__documents_cache__[k] = kw.pop(k)
+
+        # embed documents are attached through their property
+        embed_docs = {}
+        for k in self.__embed_documents__.keys():
+            v = kw.get(k)
+            if isinstance(v, Document) or (isinstance(v, list) and
+                    [d for d in v if isinstance(d, Document)]):
+                embed_docs[k] = kw.pop(k)
+
+        # files are uploaded on save, only their ids are stored
+        for k in self.__file_properties__.keys():
+            if kw.get(k) is not None and not isinstance(kw[k], ObjectId):
+                self.__documents_cache__[k] = kw.pop(k)
+
+        # values given here are stored like when set later, loaded values
+        # are converted already and left as they are
+        for k, prop in self.__converted_properties__.iteritems():
+            if kw.get(k) is not None:
+                kw[k] = prop.get_value_for_mongo(kw[k])
 
         super(Document, self).__init__(*args, **kw)
 
+        for k, v in embed_docs.iteritems():
+            self.__embed_documents__[k].__set__(self, v)
+
+        # not loaded, changed until it is written, loaded documents are
+        # cleared again
+        self._mark_changed('_id')
+
+    def _init_state(self):
+        # only documents holding referenced or embed documents, files to
+        # upload or decompressed binaries need a cache
+        cache = None
+        if self.__referenced_documents__ or self.__embed_documents__ or \
+                self.__file_properties__ or self.__binary_properties__:
+            cache = dict()
+        object.__setattr__(self, '__documents_cache__', cache)
+        if self.__compact__:
+            object.__setattr__(self, '__changed_fields__', None)
+        if self.__embedded__:
+            object.__setattr__(self, '_parent', None)
+            object.__setattr__(self, '_parent_field', None)
+
     def __getattr__(self, name):
-        if name in self.__properties__.keys():
+        if name in self.__properties__:
             return self.__properties__[name].__get__(self, self.__class__)
-        elif name == '_id':
-            return None
         else:
             return super(Document, self).__getattribute__(name)
 
     def __setattr__(self, key, value):
-        def _install_property():
-            self.__properties__.update({ key: value })
-            self.__properties__[key]._field_name = key
-            self.__properties__[key]._document_class = self.__class__
-            self.__properties__[key].__set__(self, value._value)
-
-        if key in self.__properties__.keys():
+        if key in self.__properties__:
             self.__properties__[key].__set__(self, value)
-        elif key == '_id':
-            if not isinstance(value, ObjectIdProperty):
-                value = ObjectIdProperty(value)
-            _install_property()
-        else:
-            if isinstance(value, Property) and self.__expandable__:
-                _install_property()
+        elif isinstance(value, Property) and self.__expandable__:
+            self._install_property(key, value)
+
+    def _install_property(self, key, prop):
+        # dynamic properties live in a per-instance overlay, the class
+        # level __properties__ are shared and never touched
+        properties = self.__dict__.get('__properties__')
+        if properties is None:
+            properties = _PropertyOverlay(self.__class__.__properties__)
+            self.__dict__['__properties__'] = properties
+        prop = copy(prop)
+        prop.attach(self.__class__, key)
+        properties[key] = prop
+        prop.__set__(self, prop._value)
 
     def __setitem__(self, key, value):
-        if key not in self.__properties__.keys():
-            if key == '_id' and not isinstance(value, Property):
-                self.__setattr__(key, ObjectIdProperty(value))
-            else:
-                self.__setattr__(key, value)
+        if key not in self.__properties__:
+            self.__setattr__(key, value)
         else:
             value = self.__properties__[key].get_value_for_mongo(value)
             super(Document, self).__setitem__(key, value)
+            self._mark_changed(key)
+
+    def _set_raw(self, key, value):
+        super(Document, self).__setitem__(key, value)
+
+    def _mark_changed(self, key):
+        changed = self.__changed_fields__
+        if changed is None:
+            with _state_lock:
+                changed = self.__changed_fields__
+                if changed is None:
+                    changed = set()
+                    object.__setattr__(self, '__changed_fields__', changed)
+        changed.add(key)
+        if self.__embedded__ and self._parent is not None:
+            self._parent._mark_changed(self._parent_field)
+
+    def _clear_changed(self):
+        object.__setattr__(self, '__changed_fields__', None)
+
+    @property
+    def is_changed(self):
+        """True for documents never saved or modified since the last save
+        """
+        return self._id is None or bool(self.__changed_fields__)
 
     def __getitem__(self, key):
         try:
@@ -288,8 +1174,9 @@ class Document(dict):
                 return None
             value = self.__properties__[key].default_value()
 
-        if isinstance(self.__properties__[key], ReferenceProperty):
-            return self.__documents_cache__[key]
+        if isinstance(self.__properties__[key], (ReferenceProperty,
+                EmbedDocumentProperty, BinaryProperty)):
+            return self.__properties__[key].__get__(self, self.__class__)
 
         return self.__properties__[key].make_value_from_mongo(value)
 
@@ -300,25 +1187,54 @@ class Document(dict):
             raise AttributeError, e
 
     def __repr__(self):
-        return '<Document ' + dict.__repr__(self) + '>'
+        return '<Document ' + dict.__repr__(self._mongo_data()) + '>'
+
+    def _mongo_data(self):
+        """Returns the dict handed to pymongo, compact documents and
+        compact embed documents are converted to plain dicts.
+        """
+        if not self.__compact__ and not self.__compact_embeds__:
+            if self.__embedded__:
+                return self._data
+            return self
+        data = {}
+        for k, v in self.iteritems():
+            if isinstance(v, Document):
+                v = v._mongo_data()
+            elif isinstance(v, list) and k in self.__embed_documents__:
+                v = [d._mongo_data() if isinstance(d, Document) else d for d in v]
+            data[k] = v
+        return data
 
     def _validate_required_properties(self):
         for k in self.__required_properties__.keys():
-            if not self.get(k):
+            value = self.get(k)
+            if not value and k in self.__referenced_documents__:
+                value = self.__documents_cache__.get(k)
+            if not value:
                 raise ValidationError('%s is required' % k)
 
     def _validate_unique_properties(self):
         for k in self.__unique_properties__.keys():
             value = self.get(k)
             if value:
-                if self.m.find_one({ k: value }):
+                spec = { k: value }
+                if self._id is not None:
+                    spec['_id'] = { '$ne': self._id }
+                if self.m.find_one(spec):
                     raise ValidationError('Value %s for %s exist already. ' % (value, k))
             else:
                 raise ValidationError('%s is required' % k)
 
+    def _validate_properties(self):
+        # references not loaded are not validated
+        refs = self.__referenced_documents__
+        [v.validate(self[k]) for k, v in self.__properties__.iteritems()
+            if k not in refs or k in self.__documents_cache__]
+
     def validate(self):
         #property validators validate
-        [v.validate(self[k]) for k, v in self.__properties__.iteritems()]
+        self._validate_properties()
 
         #required properties validate
         self._validate_required_properties()
@@ -330,6 +1246,56 @@ class Document(dict):
     def from_raw_data(cls, **data):
         return cls(**data)
 
+    @classmethod
+    def _json_fields(cls, data, fields=None, properties=None):
+        # stored values converted by their properties, without wrappers
+        properties = properties or cls.__properties__
+        result = {}
+        for k in fields or data.keys():
+            if k in ('_classes', '_class_name'):
+                continue
+            value = dict.get(data, k, _MISSING)
+            if value is _MISSING:
+                continue
+            prop = properties.get(k)
+            if prop is not None and value is not None:
+                value = prop.get_value_for_json(value)
+            result[k] = value
+        return result
+
+    def _json_data(self, fields=None, expand=()):
+        data = self._json_fields(self._mongo_data(), fields, self.__properties__)
+        # references assigned or loaded are taken from the cache
+        cache = self.__documents_cache__ or {}
+        for k, prop in self.__referenced_documents__.iteritems():
+            if fields and k not in fields or k not in cache and k not in expand:
+                continue
+            value = prop.__get__(self, self.__class__)
+            if isinstance(value, list):
+                data[k] = [_json_reference(d, k in expand) for d in value]
+            else:
+                data[k] = _json_reference(value, k in expand)
+        return data
+
+    def to_dict(self):
+        """Returns the stored data as a plain dict, also for `__compact__`
+        documents, which `dict()` sees as empty.
+        """
+        return dict(self._mongo_data())
+
+    def to_json(self, fields=None, expand=()):
+        """Returns the document as JSON, ObjectIds as strings and datetimes
+        in ISO format. References are given by their id unless listed in
+        `expand`, `fields` selects the fields to include.
+        """
+        return json.dumps(self._json_data(fields, expand), default=_json_default)
+
+    @classmethod
+    def _class_fields(cls):
+        classes = cls.__super_classes__.keys()
+        classes.append(cls.__class_name__)
+        return { '_classes': classes, '_class_name': cls.__class_name__ }
+
     @property
     def id(self):
         if not hasattr(self, '_id'):
@@ -339,33 +1305,222 @@ class Document(dict):
     def _save_children(self):
         [prop.save(self) for prop in self.__referenced_documents__.values()]
         [prop.save(self) for prop in self.__embed_documents__.values()]
+        [prop.save(self) for prop in self.__file_properties__.values()]
+
+    def _loaded_documents(self, properties):
+        # only documents loaded already, nothing is fetched here
+        cache = self.__documents_cache__ or {}
+        for k in properties.keys():
+            value = cache.get(k)
+            if value is None:
+                value = self.get(k)
+            if isinstance(value, Document):
+                yield value
+            elif isinstance(value, list):
+                for doc in value:
+                    if isinstance(doc, Document):
+                        yield doc
+            elif isinstance(value, _EmbedDocumentList):
+                for doc in value._docs.values():
+                    yield doc
+
+    def _save_graph(self, graph, seen):
+        """Collects the new and changed documents reachable from this one,
+        referenced documents first. Every document is visited once, so
+        cycles end here.
+        """
+        if id(self) in seen:
+            return
+        seen.add(id(self))
+        [doc._save_graph(graph, seen) for doc in
+            self._loaded_documents(self.__referenced_documents__)]
+        [doc._save_graph(graph, seen) for doc in
+            self._loaded_documents(self.__embed_documents__)]
+        if not self.__embedded__ and self._needs_save():
+            graph.append(self)
+
+    def _needs_save(self):
+        # dicts and lists changed in place are not tracked, documents
+        # holding some are always saved
+        return self.is_changed or \
+            bool([k for k in self.__container_properties__ if self.get(k)])
+
+    def _set_timestamps(self, now):
+        for k in self.__auto_now__:
+            self[k] = now
+        for k in self.__auto_now_add__:
+            if self._id is None or self.get(k) is None:
+                self[k] = now
+
+    def _validation_data(self, now):
+        """Returns the row save() would write, as far as it is known before
+        anything is written: the timestamps are set, referenced documents
+        and files saved along stand in with a new id.
+        """
+        data = dict(self._mongo_data())
+        for k in self.__auto_now__:
+            data[k] = now
+        for k in self.__auto_now_add__:
+            if self._id is None or data.get(k) is None:
+                data[k] = now
+        cache = self.__documents_cache__ or {}
+        for k in self.__referenced_documents__.keys() + self.__file_properties__.keys():
+            if k not in cache or cache[k] is None:
+                continue
+            if isinstance(cache[k], list):
+                data[k] = [getattr(d, '_id', None) or ObjectId() for d in cache[k]]
+            else:
+                data[k] = getattr(cache[k], '_id', None) or ObjectId()
+        return data
 
-    def save(self, *args, **kw):
-        #do validate before save into db
-        self.validate()
-
-        #save referenced and embed documents at first
-        self._save_children()
-
-        if self.__inherit_enabled__:
-            classes = self.__super_classes__.keys()
-            classes.append(self.__class_name__)
-            super(Document, self).__setitem__('_classes', classes)
-            super(Document, self).__setitem__('_class_name', self.__class_name__)
+    def _saved(self):
+        self._clear_changed()
+        for doc in self._loaded_documents(self.__embed_documents__):
+            doc._saved()
+        for value in (self.__documents_cache__ or {}).values():
+            if isinstance(value, _EmbedDocumentList):
+                value._reset()
 
-        self.m.save(self, *args, **kw)
+    def save(self, *args, **kw):
+        """Saves this document together with the new and changed documents
+        it references, directly or through embed documents.
+
+        The object graph is walked once: every document is validated once,
+        unchanged referenced documents are skipped and new documents get
+        their ids up front, so references between them (cycles included)
+        can be stored, and are inserted with one bulk insert per collection.
+        """
+        graph = []
+        self._save_graph(graph, set())
+        if not [doc for doc in graph if doc is self]:
+            graph.append(self)
+        for doc in graph:
+            windows = (doc.__documents_cache__ or {}).get(_WINDOWS)
+            if windows:
+                raise ValidationError('%s is loaded with a window of %s, it '
+                    'can not be saved as a whole' % (doc.__class_name__,
+                    ', '.join(sorted(windows))))
+
+        timestamped = [doc for doc in graph
+            if doc.__auto_now__ or doc.__auto_now_add__]
+        if timestamped:
+            now = datetime.utcnow()
+            # mongodb keeps milliseconds only
+            now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+            [doc._set_timestamps(now) for doc in timestamped]
 
-    def remove(self):
-        self.m.remove(self)
+        #do validate before save into db
+        [doc.validate() for doc in graph]
+
+        new_docs = [doc for doc in graph if doc._id is None]
+        [doc._set_raw('_id', ObjectId()) for doc in new_docs]
+
+        #store references to referenced and embed documents
+        with _state_lock:
+            for doc in graph:
+                doc._save_children()
+                if doc.__inherit_enabled__:
+                    for k, v in doc._class_fields().iteritems():
+                        doc._set_raw(k, v)
+
+        new_ids = set(id(doc) for doc in new_docs)
+        behind = [doc for doc in graph if doc.__write_behind__]
+        for doc in behind:
+            # saved from now on, changed again if the write fails
+            with _state_lock:
+                doc._saved()
+            write_behind_queue(doc.__write_behind__).put(doc,
+                new=id(doc) in new_ids)
+
+        new_by_collection = {}
+        for doc in new_docs:
+            if not doc.__write_behind__:
+                new_by_collection.setdefault(doc.__collection_name__, []).append(doc)
+        written = []
+        try:
+            for docs in new_by_collection.values():
+                docs[0].m.insert_many(docs, *args, **kw)
+                written.extend(docs)
+            for doc in graph:
+                if id(doc) not in new_ids and not doc.__write_behind__:
+                    doc.m.save(doc, *args, **kw)
+                    written.append(doc)
+        finally:
+            written = set(id(doc) for doc in written)
+            for doc in graph:
+                if doc.__file_properties__ and not doc.__write_behind__:
+                    if id(doc) in written:
+                        doc._written(doc)
+                    else:
+                        doc._write_failed(doc)
+
+        with _state_lock:
+            [doc._saved() for doc in graph if not doc.__write_behind__]
+
+    def _written(self, data):
+        # `data` is the row written, the files it replaced are deleted.
+        # Called by write behind threads too
+        with _state_lock:
+            for k, prop in self.__file_properties__.iteritems():
+                prop.written(self, data.get(k))
+
+    def _write_failed(self, data):
+        # the fields of the row are changed again, so the next save()
+        # writes them
+        with _state_lock:
+            for k, prop in self.__file_properties__.iteritems():
+                prop.write_failed(self, data.get(k))
+            [self._mark_changed(k) for k in data.keys()]
+
+    def remove(self, **kw):
+        self.m.remove(self._mongo_data(), **kw)
+        [prop.remove(self) for prop in self.__file_properties__.values()]
+
+    def _update_atomically(self, field, value, **kw):
+        if self._id is None:
+            raise DocumentNotSavedError('%s is not saved yet' % self.__class_name__)
+        if field in self.__properties__:
+            self.__properties__[field].validate(value)
+        self.m.update_one({ '_id': self._id }, **kw)
+        self._set_raw(field, value)
+
+    def inc(self, field, amount=1, **kw):
+        """Atomically increments `field` by `amount` in the database and
+        on this document.
+        """
+        self.m._update_operand('$inc', field, amount)
+        value = (self.get(field) or 0) + amount
+        self._update_atomically(field, value, inc={ field: amount }, **kw)
+
+    def push(self, field, value, **kw):
+        """Atomically appends `value` to the list `field`.
+        """
+        value = self.m._update_operand('$push', field, value)
+        values = list(self.get(field) or [])
+        values.append(value)
+        self._update_atomically(field, values, push={ field: value }, **kw)
+
+    def add_to_set(self, field, value, **kw):
+        """Atomically appends `value` to the list `field` unless it is
+        there already.
+        """
+        value = self.m._update_operand('$addToSet', field, value)
+        values = list(self.get(field) or [])
+        if value not in values:
+            values.append(value)
+        self._update_atomically(field, values, add_to_set={ field: value }, **kw)
 
 
 class EmbedDocument(Document):
+    __slots__ = ()
+    __embedded__ = True
+
     def __repr__(self):
-        return '<Embed Document %s >' % dict.__repr__(self)
+        return '<Embed Document %s >' % dict.__repr__(self._mongo_data())
 
     def validate(self):
         #property validators validate
-        [v.validate(self[k]) for k, v in self.__properties__.iteritems()]
+        self._validate_properties()
 
         #required properties validate
         self._validate_required_properties()
@@ -374,9 +1529,36 @@ class EmbedDocument(Document):
     def id(self):
         return None
 
+    @property
+    def is_changed(self):
+        return bool(self.__changed_fields__)
+
+    @classmethod
+    def _view(cls, data, parent=None, field=None):
+        """Returns an embed document holding the values of `data`, copied
+        once, to be stored in the parent in place of `data`
+        """
+        if isinstance(data, cls):
+            doc = data
+        elif cls.__compact__:
+            doc = cls.from_raw_data(**data)
+            doc._clear_changed()
+        else:
+            doc = cls.__new__(cls)
+            dict.update(doc, data)
+            doc._init_state()
+        if parent is not None:
+            doc._attach(parent, field)
+        return doc
+
+    def _attach(self, parent, field):
+        object.__setattr__(self, '_parent', parent)
+        object.__setattr__(self, '_parent_field', field)
+
     def save(self, *args, **kw):
         self.validate()
         self._save_children()
+        self._clear_changed()
 
 
 # if __name__ == "__main__":
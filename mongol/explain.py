@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
+
+
+from pymongo import ASCENDING
+
+
+# stages and cursors of geo queries, they use the geo index although they
+# are no index scans, old servers do not name it
+_GEO_STAGES = ('GEO_NEAR_2D', 'GEO_NEAR_2DSPHERE')
+_GEO_CURSORS = ('GeoSearchCursor', 'GeoBrowse', 'S2Cursor', 'S2NearCursor')
+
+
+def _winning_stages(plan):
+    # stages of a query planner tree, outermost first
+    while plan:
+        yield plan
+        if 'inputStage' in plan:
+            plan = plan['inputStage']
+        elif plan.get('inputStages'):
+            plan = plan['inputStages'][0]
+        else:
+            plan = None
+
+
+def summarize_plan(plan):
+    """Returns the essentials of an explain plan: the index used, None for a
+    collection scan, documents examined and returned and the time taken.
+    Understands the plans of old servers (`cursor`, `nscannedObjects`) and
+    the query planner output of newer ones. Geo queries give the geo stage
+    or cursor when the index is not named.
+    """
+    if 'queryPlanner' in plan:
+        index = None
+        for stage in _winning_stages(plan['queryPlanner'].get('winningPlan')):
+            if stage.get('stage') == 'IXSCAN':
+                index = stage.get('indexName')
+                break
+            if stage.get('stage') in _GEO_STAGES:
+                index = stage.get('indexName') or stage['stage']
+                break
+        stats = plan.get('executionStats', {})
+        examined = stats.get('totalDocsExamined')
+        returned = stats.get('nReturned')
+        millis = stats.get('executionTimeMillis')
+    else:
+        cursor = plan.get('cursor', '')
+        index = None
+        if cursor.startswith('BtreeCursor'):
+            index = cursor.split()[1]
+        elif cursor.startswith(_GEO_CURSORS):
+            index = cursor.split()[0]
+        examined = plan.get('nscannedObjects', plan.get('nscanned'))
+        returned = plan.get('n')
+        millis = plan.get('millis')
+    return {
+        'index': index,
+        'collection_scan': index is None,
+        'examined': examined,
+        'returned': returned,
+        'millis': millis,
+    }
+
+
+def _index_keys(index):
+    if isinstance(index, basestring):
+        return [(index, ASCENDING)]
+    return list(index)
+
+
+def index_keys(doc_cls):
+    """Returns the keys of all indexes a document class has: `_id`, the
+    declared indexes and the ones its properties need. Unique properties
+    are checked with a query, they have no index of their own.
+    """
+    keys = [[('_id', ASCENDING)]]
+    keys.extend(_index_keys(index) for index, options in doc_cls.__indexes__)
+    return keys
+
+
+def query_fields(spec):
+    """Returns the fields a spec filters on, without the `_classes` filter
+    every query of an inherit enabled document has
+    """
+    fields = set()
+    for k, v in (spec or {}).iteritems():
+        if k in ('$and', '$or', '$nor'):
+            [fields.update(query_fields(s)) for s in v]
+        elif not k.startswith('$') and k != '_classes':
+            fields.add(k)
+    return fields
+
+
+def supporting_index(doc_cls, spec, sort=None):
+    """Returns the keys of an index of `doc_cls` that can serve the query,
+    one whose first key is filtered on, or sorted on for queries without
+    filter. Returns None if there is none.
+    """
+    fields = query_fields(spec)
+    sort_fields = [k for k, direction in sort or []]
+    for keys in index_keys(doc_cls):
+        first = keys[0][0]
+        if first in fields or not fields and sort_fields[:1] == [first]:
+            return keys
+    if not fields and not sort_fields:
+        # fetching everything, no index would help
+        return []
+    return None
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
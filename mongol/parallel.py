@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
+
+
+import atexit
+import threading
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+
+from bson import BSON
+
+from validator import ValidationError
+
+
+# document classes validated so far, the forked workers inherit them, so
+# only an index is sent along with the rows
+_classes = []
+_lock = threading.Lock()
+# the pool is kept for the next validation, it is forked again only when
+# its workers do not know all classes or have another size
+_pool = None
+_pool_classes = 0
+_pool_size = 0
+
+
+def _check(doc):
+    # everything but the unique properties, those need the database
+    doc._validate_properties()
+    doc._validate_required_properties()
+
+
+def _validate_chunk(chunk):
+    from document import _hydrate
+    errors = []
+    for i, class_index, raw in chunk:
+        doc = _hydrate(_classes[class_index], BSON(raw).decode())
+        try:
+            _check(doc)
+        except ValidationError, e:
+            errors.append((i, unicode(e)))
+    return errors
+
+
+def _get_pool(processes):
+    global _pool, _pool_classes, _pool_size
+    if _pool is not None and (_pool_classes < len(_classes) or
+            _pool_size != processes):
+        _close_pool()
+    if _pool is None:
+        _pool = Pool(processes)
+        _pool_classes = len(_classes)
+        _pool_size = processes
+    return _pool
+
+
+def _close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+atexit.register(_close_pool)
+
+
+def _validate_rows(rows, processes=None, chunk_size=500):
+    """Validates (document class, row) pairs, returns the (index, message)
+    pairs of the invalid ones
+    """
+    with _lock:
+        chunks = []
+        for i, (doc_cls, row) in enumerate(rows):
+            if doc_cls not in _classes:
+                _classes.append(doc_cls)
+            if i % chunk_size == 0:
+                chunks.append([])
+            chunks[-1].append((i, _classes.index(doc_cls), BSON.encode(row)))
+        if not chunks:
+            return []
+
+        processes = min(processes or cpu_count(), len(chunks))
+        if processes == 1:
+            results = map(_validate_chunk, chunks)
+        else:
+            try:
+                results = _get_pool(processes).map(_validate_chunk, chunks)
+            except Exception:
+                # workers may be gone, the next call starts new ones
+                _close_pool()
+                raise
+    return [error for errors in results for error in errors]
+
+
+def validate_many(docs, processes=None, chunk_size=500):
+    """Validates documents on a pool of `processes` worker processes, one
+    per core by default. Returns the positions of the invalid documents
+    with their ValidationError, e.g. to skip them in a bulk import:
+
+        invalid = dict(validate_many(docs))
+        Person.m.insert_many([doc for i, doc in enumerate(docs)
+            if i not in invalid])
+
+    The documents are sent to the workers as BSON in chunks of
+    `chunk_size` and validated there like `Document.validate` does, unique
+    properties are checked here afterwards. They are sent as `save()`
+    would write them: timestamps of `auto_now` properties are set, and
+    referenced documents and files not saved yet count as given, they are
+    checked when saved themselves. The workers are forked, so this works
+    on posix systems only, the pool is kept for the next call.
+    """
+    docs = list(docs)
+    now = datetime.utcnow()
+    errors = dict((i, ValidationError(message)) for i, message in
+        _validate_rows([(doc.__class__, doc._validation_data(now))
+            for doc in docs], processes, chunk_size))
+    for i, doc in enumerate(docs):
+        if doc.__unique_properties__ and i not in errors:
+            try:
+                doc._validate_unique_properties()
+            except ValidationError, e:
+                errors[i] = e
+    return sorted(errors.items())
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
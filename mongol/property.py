@@ -3,11 +3,18 @@
 # Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
 
 
+import base64
+import bz2
+import zlib
 from copy import deepcopy
 
+from pymongo import ASCENDING, GEO2D
 from pymongo.objectid import ObjectId
 from pymongo.dbref import DBRef
+from pymongo.binary import Binary
+from gridfs import GridFS
 from validator import *
+from query import Condition
 
 
 class Property(object):
@@ -28,9 +35,46 @@ class Property(object):
         return value
 
     def __set__(self, obj, value):
-        self._value = value
         obj[self._field_name] = value
 
+    # comparing a property of a document class gives a query condition,
+    # e.g. `Blog.views > 10`
+    __hash__ = object.__hash__
+
+    def _condition(self, operator, value):
+        return Condition(self._field_name, operator, self.get_value_for_query(value))
+
+    def __eq__(self, value):
+        # properties themselves compare by identity, e.g. in `in` checks
+        if isinstance(value, Property):
+            return self is value
+        return self._condition(None, value)
+
+    def __ne__(self, value):
+        if isinstance(value, Property):
+            return self is not value
+        return self._condition('$ne', value)
+
+    def __lt__(self, value):
+        return self._condition('$lt', value)
+
+    def __le__(self, value):
+        return self._condition('$lte', value)
+
+    def __gt__(self, value):
+        return self._condition('$gt', value)
+
+    def __ge__(self, value):
+        return self._condition('$gte', value)
+
+    def in_(self, values):
+        return Condition(self._field_name, '$in',
+            [self.get_value_for_query(v) for v in values])
+
+    def not_in(self, values):
+        return Condition(self._field_name, '$nin',
+            [self.get_value_for_query(v) for v in values])
+
     def attach(self, cls, name):
         self._document_class = cls
         self._field_name = name
@@ -41,6 +85,26 @@ class Property(object):
     def get_value_for_mongo(self, value):
         return value
 
+    def get_operand_for_mongo(self, operator, value):
+        if operator == '$set':
+            return self.get_value_for_mongo(value)
+        return value
+
+    def get_value_for_query(self, value):
+        """converts the operand of a query condition
+        """
+        return self.get_value_for_mongo(value)
+
+    def get_value_for_json(self, value):
+        """converts a stored value for `Document.to_json`
+        """
+        return value
+
+    def indexes(self):
+        """Returns the indexes this property needs, as (keys, options)
+        """
+        return []
+
     def validate(self, value):
         if value:
             [v(value) for v in self._validators]
@@ -48,6 +112,29 @@ class Property(object):
             # print 'Value is not set'
             pass
 
+    def validate_column(self, values):
+        """validates the values of many documents at once, values not set
+        are skipped like in `validate`
+        """
+        values = [value for value in values if value]
+        [v.validate_column(values) for v in self._validators]
+
+    def validate_operand(self, operator, value):
+        """validates the operand of an atomic update operator like `$inc`
+        """
+        if operator == '$inc':
+            if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                raise ValidationError('%s can only be incremented by a number' % self._field_name)
+            # ranges apply to the result, not to the increment
+            [v(value) for v in self._validators if not isinstance(v, NumberRange)]
+        elif operator in ('$push', '$addToSet', '$pull'):
+            raise ValidationError('%s is not a list' % self._field_name)
+        elif operator == '$unset':
+            if self.required or self.unique:
+                raise ValidationError('%s is required' % self._field_name)
+        elif operator == '$set':
+            self.validate(value)
+
     def default_value(self):
         if callable(self.default):
             return self.default()
@@ -108,6 +195,9 @@ class ObjectIdProperty(Property):
         super(ObjectIdProperty, self).__init__(*args, **kw)
         self._validators.append(ObjectIdValidator())
 
+    def get_value_for_json(self, value):
+        return unicode(value)
+
     # def get_value_for_mongo(self, value):
         # if not isinstance(value, ObjectId):
             # return ObjectId(unicode(value))
@@ -126,22 +216,103 @@ class FloatProperty(Property):
 
 
 class GeoPtProperty(Property):
+    """A (x, y) point with a geospatial index, a `2d` index on the plain
+    pair by default or a `2dsphere` index on a GeoJSON point with
+    `geojson=True`. Set `index=False` to manage the index yourself.
+    """
     def __init__(self, *args, **kw):
+        self.geojson = kw.pop('geojson', False)
+        self._index = kw.pop('index', True)
         super(GeoPtProperty, self).__init__(*args, **kw)
         self._validators.append(GeoPt())
 
+    def make_value_from_mongo(self, value):
+        if self.geojson and isinstance(value, dict):
+            return tuple(value['coordinates'])
+        return value
+
+    def get_value_for_mongo(self, value):
+        if self.geojson and isinstance(value, (tuple, list)):
+            return { 'type': 'Point', 'coordinates': list(value) }
+        return value
+
+    def get_value_for_json(self, value):
+        return list(self.make_value_from_mongo(value))
+
+    def indexes(self):
+        if not self._index:
+            return []
+        if self.geojson:
+            return [([(self._field_name, '2dsphere')], {})]
+        return [([(self._field_name, GEO2D)], {})]
+
+    def near_spec(self, point, max_distance=None):
+        if self.geojson:
+            spec = { '$geometry': self.get_value_for_mongo(point) }
+            if max_distance is not None:
+                spec['$maxDistance'] = max_distance
+            return { '$near': spec }
+        spec = { '$near': list(point) }
+        if max_distance is not None:
+            spec['$maxDistance'] = max_distance
+        return spec
+
+    def within_polygon_spec(self, points):
+        if self.geojson:
+            ring = [list(p) for p in points]
+            if ring[0] != ring[-1]:
+                ring.append(ring[0])
+            return { '$geoWithin': { '$geometry': { 'type': 'Polygon',
+                'coordinates': [ring] } } }
+        return { '$within': { '$polygon': [list(p) for p in points] } }
+
+    def within_box_spec(self, bottom_left, top_right):
+        if self.geojson:
+            (x1, y1), (x2, y2) = bottom_left, top_right
+            return self.within_polygon_spec([(x1, y1), (x2, y1), (x2, y2), (x1, y2)])
+        return { '$within': { '$box': [list(bottom_left), list(top_right)] } }
+
 
 class DateTimeProperty(Property):
+    """A datetime.
+
+    `auto_now` sets the value to the current time on each save,
+    `auto_now_add` only when the document is saved the first time. With
+    `ttl` (seconds) a TTL index lets the server remove expired documents.
+    """
     def __init__(self, *args, **kw):
         self.auto_now = kw.pop('auto_now', False)
         self.auto_now_add = kw.pop('auto_now_add', False)
-        # XXX, TODO
+        self.ttl = kw.pop('ttl', None)
         super(DateTimeProperty, self).__init__(*args, **kw)
         self._validators.append(DateTime())
 
+    def get_value_for_mongo(self, value):
+        # e.g. datetime.utcnow
+        if callable(value):
+            value = value()
+        return value
+
+    def get_value_for_json(self, value):
+        return value.isoformat()
+
+    def indexes(self):
+        if self.ttl is None:
+            return []
+        return [([(self._field_name, ASCENDING)], { 'expireAfterSeconds': self.ttl })]
+
 
 class ReferenceProperty(Property):
+    """A reference to a document of `reference_class`.
+
+    Stored as a `DBRef` by default, or as the bare ObjectId with
+    `dbref=False` as the collection is known from the reference class.
+    The referenced document is loaded on first access, use
+    `CollectionManager.resolve_references` to load the references of many
+    documents at once.
+    """
     def __init__(self, reference_class, *args,**kw):
+        self._dbref = kw.pop('dbref', True)
         super(ReferenceProperty, self).__init__(*args, **kw)
         self._reference_class = reference_class
         self._validators.append(DocumentValidator())
@@ -150,38 +321,306 @@ class ReferenceProperty(Property):
         if obj is None:
             return self
 
-        if self._field_name not in obj.__documents_cache__.keys():
-            value = obj.get(self._field_name)
-            print 'XDSxdfa'
-            print value
-            if value:
-                value = self._reference_class.from_raw_data(
-                    **(self._reference_class.m.db.dereference(value)))
-                obj.__documents_cache__[self._field_name] = value
-            else:
-                return None
-        # XXX
-        value = obj.__documents_cache__[self._field_name]
-        if isinstance(value, DBRef):
-            value =self._reference_class.from_raw_data(
-                **(self._reference_class.m.db.dereference(value)))
-            obj.__documents_cache__[self._field_name] = value
+        if self._field_name not in obj.__documents_cache__:
+            obj.m.resolve_references([obj], self._field_name)
         return obj.__documents_cache__[self._field_name]
 
     def __set__(self, obj, value):
         obj.__documents_cache__[self._field_name] = value
 
-    def save(self, obj):
-        doc = obj.__documents_cache__[self._field_name]
+    def _reference_id(self, value):
+        if isinstance(value, DBRef):
+            return value.id
+        return value
+
+    def get_value_for_json(self, value):
+        return unicode(self._reference_id(value))
+
+    def get_value_for_query(self, value):
+        # referenced documents are matched by the reference stored
+        if isinstance(value, list):
+            return [self.get_value_for_query(v) for v in value]
+        if getattr(value, '__collection_name__', None) is None:
+            return value
+        if value._id is None:
+            raise ValidationError('%s is not saved yet' % value.__class_name__)
+        return self._value_for_reference(value)
+
+    def _pending_ids(self, obj):
+        """Returns the ids to load for `obj`, None if loaded already
+        """
+        if self._field_name in obj.__documents_cache__:
+            return None
+        value = obj.get(self._field_name)
+        if value is None:
+            return []
+        return [self._reference_id(value)]
+
+    def _resolved(self, obj, docs):
+        obj.__documents_cache__[self._field_name] = docs and docs[0] or None
+
+    def _value_for_reference(self, doc):
         if doc._id is None:
             doc.save()
+        if not self._dbref:
+            return doc.id
         collection_name = doc.__collection_name__
         db_name = doc.m.db.name # if has a database name argument can support across database
-        obj[self._field_name] = DBRef(collection_name, doc.id, db_name)
+        return DBRef(collection_name, doc.id, db_name)
+
+    def validate(self, value):
+        if value is not None:
+            [v(value) for v in self._validators]
+
+    def save(self, obj):
+        if self._field_name not in obj.__documents_cache__:
+            # never loaded, nothing changed
+            return
+        doc = obj.__documents_cache__[self._field_name]
+        if doc is None:
+            obj[self._field_name] = None
+        else:
+            obj[self._field_name] = self._value_for_reference(doc)
+
+
+class ReferenceListProperty(ReferenceProperty):
+    """A list of references to documents of `reference_class`, all loaded
+    with a single `$in` query.
+    """
+    def __init__(self, reference_class, *args, **kw):
+        super(ReferenceListProperty, self).__init__(reference_class, *args, **kw)
+        self._validators = [v for v in self._validators
+            if not isinstance(v, DocumentValidator)]
+
+    def _pending_ids(self, obj):
+        if self._field_name in obj.__documents_cache__:
+            return None
+        return [self._reference_id(v) for v in obj.get(self._field_name) or []]
+
+    def _resolved(self, obj, docs):
+        obj.__documents_cache__[self._field_name] = [d for d in docs if d is not None]
+
+    def get_value_for_json(self, value):
+        return [unicode(self._reference_id(v)) for v in value]
+
+    def validate(self, value):
+        if value is not None:
+            [v(value) for v in self._validators]
+            [DocumentValidator()(doc) for doc in value]
+
+    def save(self, obj):
+        if self._field_name not in obj.__documents_cache__:
+            return
+        docs = obj.__documents_cache__[self._field_name] or []
+        obj[self._field_name] = [self._value_for_reference(doc) for doc in docs]
+
+
+# user defined binary subtypes marking compressed values, so they are read
+# back whatever codec the property uses now
+_CODECS = {
+    'zlib': (0x80, zlib.compress, zlib.decompress),
+    'bz2': (0x81, bz2.compress, bz2.decompress),
+}
+_DECOMPRESS = dict((subtype, decompress)
+    for subtype, compress, decompress in _CODECS.values())
 
 
 class BinaryProperty(Property):
-    pass
+    """Bytes stored inline as BSON binary, read as a `memoryview`.
+
+    With `compress` ('zlib' or 'bz2') values are compressed when set and
+    decompressed on first read, values not getting smaller are stored as
+    they are. Values longer than `max_size` bytes are refused. `stats()`
+    tells how well the stored values compressed.
+    """
+    def __init__(self, *args, **kw):
+        compress = kw.pop('compress', None)
+        if compress is not None and compress not in _CODECS:
+            raise ValueError('Unknown codec %s' % compress)
+        self._codec = compress and _CODECS[compress]
+        self.max_size = kw.pop('max_size', None)
+        super(BinaryProperty, self).__init__(*args, **kw)
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+
+        value = obj.get(self._field_name)
+        if value is None:
+            return None
+        # decompressed once, until the stored value changes
+        cache = obj.__documents_cache__
+        if cache is None:
+            return self.make_value_from_mongo(value)
+        cached = cache.get(self._field_name)
+        if cached is not None and cached[0] is value:
+            return cached[1]
+        view = self.make_value_from_mongo(value)
+        cache[self._field_name] = (value, view)
+        return view
+
+    def make_value_from_mongo(self, value):
+        if value is None:
+            return None
+        decompress = _DECOMPRESS.get(getattr(value, 'subtype', None))
+        if decompress is not None:
+            value = decompress(value)
+        return memoryview(value)
+
+    def get_value_for_mongo(self, value):
+        if value is None or isinstance(value, Binary):
+            return value
+        if not isinstance(value, (str, bytearray, memoryview, buffer)):
+            raise ValidationError('%s must be bytes' % self._field_name)
+        if self.max_size is not None and len(value) > self.max_size:
+            raise ValidationError('%s is longer than %d bytes' % (
+                self._field_name, self.max_size))
+
+        data = str(value) if not isinstance(value, memoryview) else value.tobytes()
+        stored = Binary(data)
+        if self._codec:
+            subtype, compress, decompress = self._codec
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                stored = Binary(compressed, subtype)
+        return stored
+
+    def get_value_for_json(self, value):
+        return base64.b64encode(self.make_value_from_mongo(value).tobytes())
+
+    def stats(self, spec=None):
+        """Returns the number of values stored in the documents matching
+        `spec`, their size and their stored size in bytes and the ratio of
+        both. The values are read from the collection on each call.
+        """
+        manager = self._document_class.m
+        args, kw = manager._wrap_arguments(spec or {},
+            fields=[self._field_name])
+        values = raw_bytes = stored_bytes = 0
+        for row in manager.collection.find(*args, **manager._read_options(kw)):
+            value = row.get(self._field_name)
+            if value is None:
+                continue
+            values += 1
+            raw_bytes += len(self.make_value_from_mongo(value))
+            stored_bytes += len(value)
+        return {
+            'values': values,
+            'raw_bytes': raw_bytes,
+            'stored_bytes': stored_bytes,
+            'ratio': raw_bytes and float(stored_bytes) / raw_bytes or 1.0,
+        }
+
+
+class FileProperty(Property):
+    """A file stored in GridFS, the document keeps its id only.
+
+    Set a string or a file-like object, it is uploaded in chunks of
+    `chunk_size` when the document is saved. The previous file is deleted
+    once the document is written, the new one if writing fails.
+    Reading gives a file-like object fetching the chunks it needs on
+    demand, e.g. `doc.video.read_range(2 ** 20, 4096)`. The file is deleted
+    by `Document.remove`, not by `CollectionManager.remove`.
+    """
+    def __init__(self, *args, **kw):
+        self._collection = kw.pop('collection', 'fs')
+        self._chunk_size = kw.pop('chunk_size', None)
+        self._content_type = kw.pop('content_type', None)
+        super(FileProperty, self).__init__(*args, **kw)
+        self._grid = None
+
+    def _fs(self, obj):
+        # GridFS ensures its index when created, once per database
+        db = obj.m.db
+        if self._grid is None or self._grid[0] is not db:
+            self._grid = (db, GridFS(db, self._collection))
+        return self._grid[1]
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+
+        cache = obj.__documents_cache__
+        if self._field_name in cache:
+            # not uploaded yet
+            return cache[self._field_name]
+        file_id = obj.get(self._field_name)
+        if file_id is None:
+            return None
+        return _GridFile(self._fs(obj), file_id)
+
+    def __set__(self, obj, value):
+        obj.__documents_cache__[self._field_name] = value
+        obj._mark_changed(self._field_name)
+
+    def get_value_for_json(self, value):
+        return unicode(value)
+
+    def save(self, obj):
+        cache = obj.__documents_cache__
+        if self._field_name not in cache:
+            return
+        value = cache.pop(self._field_name)
+        file_id = None
+        if value is not None:
+            kw = {}
+            if self._chunk_size:
+                kw['chunkSize'] = self._chunk_size
+            if self._content_type:
+                kw['contentType'] = self._content_type
+            if getattr(value, 'name', None):
+                kw['filename'] = value.name
+            file_id = self._fs(obj).put(value, **kw)
+        # the id in the database and the ones uploaded since, the files
+        # replaced are deleted once the row is written
+        key = (self._field_name, 'uploads')
+        stored, uploads = cache.get(key, (obj.get(self._field_name), []))
+        cache[key] = (stored, uploads + [file_id])
+        obj[self._field_name] = file_id
+
+    def _delete(self, obj, file_ids, keep=None):
+        fs = self._fs(obj)
+        [fs.delete(file_id) for file_id in file_ids
+            if file_id is not None and file_id != keep]
+
+    def written(self, obj, file_id):
+        """Deletes the files replaced by `file_id` now that the row holding
+        it is written
+        """
+        cache = obj.__documents_cache__
+        key = (self._field_name, 'uploads')
+        stored, uploads = cache.get(key, (None, []))
+        if file_id not in uploads:
+            return
+        index = uploads.index(file_id)
+        self._delete(obj, [stored] + uploads[:index], keep=file_id)
+        if uploads[index + 1:]:
+            cache[key] = (file_id, uploads[index + 1:])
+        else:
+            del cache[key]
+
+    def write_failed(self, obj, file_id):
+        """Deletes the files uploaded for a row that could not be written,
+        the document refers to the file in the database again
+        """
+        cache = obj.__documents_cache__
+        key = (self._field_name, 'uploads')
+        stored, uploads = cache.get(key, (None, []))
+        if file_id not in uploads:
+            return
+        index = uploads.index(file_id)
+        self._delete(obj, uploads[:index + 1], keep=stored)
+        if uploads[index + 1:]:
+            cache[key] = (stored, uploads[index + 1:])
+        else:
+            del cache[key]
+        if obj.get(self._field_name) == file_id:
+            obj._set_raw(self._field_name, stored)
+
+    def remove(self, obj):
+        file_id = obj.get(self._field_name)
+        if file_id is not None:
+            self._fs(obj).delete(file_id)
 
 
 class DictProperty(Property):
@@ -197,37 +636,186 @@ class ListProperty(Property):
     def make_value_from_mongo(self, value):
         return _AttrList(value, self._item_type)
 
+    def validate_operand(self, operator, value):
+        if operator in ('$push', '$addToSet', '$pull'):
+            if self._item_type and not isinstance(value, self._item_type):
+                raise ValidationError('Invalid item type for %s' % self._field_name)
+        else:
+            super(ListProperty, self).validate_operand(operator, value)
+
 
 class EmbedDocumentProperty(Property):
     def __init__(self, doc_cls, *args, **kw):
         super(EmbedDocumentProperty, self).__init__(*args, **kw)
-        self._document_class = doc_cls
+        self._embed_class = doc_cls
         self._validators.append(EmbeddedDocumentValidator())
 
     def __get__(self, obj, cls):
         if obj is None:
             return self
 
-        if self._field_name not in obj.__documents_cache__.keys():
-            try:
-                value = obj[self._field_name]
-                value = self._document_class.from_raw_data(**value)
-                obj.__documents_cache__[self._field_name] = value
-            except KeyError:
-                return None
+        value = obj.get(self._field_name)
+        if value is None:
+            return None
+        if getattr(value, '__embedded__', False):
+            # materialized already
+            return value
 
-        value = obj.__documents_cache__[self._field_name]
-        if isinstance(value, dict):
-            value = self._document_class.from_raw_data(**value)
-            obj.__documents_cache__[self._field_name] = value
-        return obj.__documents_cache__[self._field_name]
+        # the embed document takes the place of the stored dict
+        doc = self._embed_class._view(value, obj, self._field_name)
+        obj._set_raw(self._field_name, doc)
+        return doc
 
     def __set__(self, obj, value):
         super(EmbedDocumentProperty, self).__set__(obj, value)
-        obj.__documents_cache__[self._field_name] = value
+        if getattr(value, '__embedded__', False):
+            value._attach(obj, self._field_name)
+
+    def get_value_for_mongo(self, value):
+        return value
+
+    def get_value_for_json(self, value):
+        return self._embed_class._json_fields(value)
+
+    def validate(self, value):
+        if value is not None:
+            [v(value) for v in self._validators]
+            value.validate()
+
+    def save(self, obj):
+        doc = self.__get__(obj, obj.__class__)
+        if doc is not None:
+            doc._save_children()
+
+
+class EmbedDocumentListProperty(EmbedDocumentProperty):
+    """A list of embed documents.
+
+    Elements are wrapped in embed documents only when accessed, taking the
+    place of the stored dicts. Only changed and appended
+    elements are validated, and `save()` on the list writes them with
+    positional `$set` and `$push` instead of rewriting the whole array.
+    """
+    def __init__(self, doc_cls, *args, **kw):
+        if doc_cls.__compact__:
+            raise ValueError('Compact embed documents can not be listed')
+        super(EmbedDocumentListProperty, self).__init__(doc_cls, *args, **kw)
+        self._validators = [v for v in self._validators
+            if not isinstance(v, EmbeddedDocumentValidator)]
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+
+        value = obj.get(self._field_name)
+        if value is None:
+            value = []
+            obj._set_raw(self._field_name, value)
+
+        docs = obj.__documents_cache__.get(self._field_name)
+        if docs is None or docs._data is not value:
+            docs = _EmbedDocumentList(self, obj, value)
+            obj.__documents_cache__[self._field_name] = docs
+        return docs
+
+    def __set__(self, obj, value):
+        obj[self._field_name] = value
+        docs = _EmbedDocumentList(self, obj, obj.get(self._field_name))
+        docs._rewrite = True
+        for index, doc in enumerate(value):
+            if getattr(doc, '__embedded__', False):
+                doc._attach(docs, index)
+                docs._docs[index] = doc
+        obj.__documents_cache__[self._field_name] = docs
+
+    def _item_for_mongo(self, value):
+        # embed documents included
+        if isinstance(value, dict):
+            return value
+        raise ValidationError('Invalid item type for %s' % self._field_name)
+
+    def get_value_for_mongo(self, value):
+        if isinstance(value, _EmbedDocumentList):
+            return value._data
+        return [self._item_for_mongo(v) for v in value]
+
+    def get_value_for_json(self, value):
+        return [self._embed_class._json_fields(v) for v in value]
+
+    def get_operand_for_mongo(self, operator, value):
+        if operator in ('$push', '$addToSet', '$pull'):
+            return self._item_for_mongo(value)
+        return super(EmbedDocumentListProperty, self).get_operand_for_mongo(operator, value)
+
+    def validate_operand(self, operator, value):
+        if operator in ('$push', '$addToSet'):
+            if isinstance(value, dict) and not isinstance(value, self._embed_class):
+                value = self._embed_class._view(value)
+            if not isinstance(value, self._embed_class):
+                raise ValidationError('Invalid item type for %s' % self._field_name)
+            value.validate()
+        elif operator != '$pull':
+            super(EmbedDocumentListProperty, self).validate_operand(operator, value)
+
+    def validate(self, value):
+        if value is not None:
+            [v(value) for v in self._validators]
+            if isinstance(value, _EmbedDocumentList):
+                value.validate()
 
     def save(self, obj):
-        obj[self._field_name].save()
+        docs = obj.__documents_cache__.get(self._field_name)
+        if docs is not None:
+            [doc._save_children() for doc in docs._docs.values()]
+
+    def slice(self, skip, limit=None):
+        """Returns a `fields` projection fetching only a window of the list,
+        e.g. `Post.m.find(fields=Post.comments.slice(-10))`. Elements of a
+        window counted from the start can be changed and saved with the
+        list's `save()`, documents loaded with a window are never saved as
+        a whole.
+        """
+        if limit is None:
+            return { self._field_name: { '$slice': skip } }
+        return { self._field_name: { '$slice': [skip, limit] } }
+
+    def elem_match(self, spec):
+        """Returns a `fields` projection fetching only the first element
+        matching `spec`
+        """
+        for k in spec.keys():
+            if not k.startswith('$') and k.split('.')[0] not in self._embed_class.__properties__:
+                raise ValidationError('%s is not a property of %s' % (k,
+                    self._embed_class.__class_name__))
+        return { self._field_name: { '$elemMatch': spec } }
+
+
+# key of the list windows of a document in its documents cache
+_WINDOWS = '$windows'
+
+
+def _list_windows(doc_cls, fields):
+    """Returns the offsets of the embed document lists a `fields`
+    projection loads a window of, None for windows counted from the end or
+    elements matched with `$elemMatch`
+    """
+    windows = {}
+    if not isinstance(fields, dict):
+        return windows
+    for k, v in fields.iteritems():
+        if not isinstance(v, dict) or not isinstance(
+                doc_cls.__properties__.get(k), EmbedDocumentListProperty):
+            continue
+        if '$slice' in v:
+            skip = v['$slice']
+            if isinstance(skip, (list, tuple)):
+                windows[k] = skip[0] if skip[0] >= 0 else None
+            else:
+                # the first or the last elements
+                windows[k] = 0 if skip >= 0 else None
+        elif '$elemMatch' in v:
+            windows[k] = None
+    return windows
 
 
 def _transform(value, value_type=None):
@@ -325,6 +913,176 @@ class _AttrDict(object):
             yield (key, _transform(value))
 
 
+class _EmbedDocumentList(object):
+    def __init__(self, prop, owner, data):
+        self._prop = prop
+        self._owner = owner
+        self._data = data
+        self._docs = {}
+        # lists loaded with a $slice or $elemMatch projection are a window
+        # of the stored array, starting at an offset or at an unknown one
+        windows = owner.__documents_cache__.get(_WINDOWS) or {}
+        self._windowed = prop._field_name in windows
+        self._offset = windows.get(prop._field_name)
+        self._window_size = len(data)
+        self._reset()
+
+    def _reset(self):
+        self._changed = set()
+        self._appended = 0
+        self._rewrite = False
+
+    def __repr__(self):
+        return '<Embed Document List %r >' % self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        for index in xrange(len(self._data)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self._data)))]
+        if index < 0:
+            index += len(self._data)
+        doc = self._docs.get(index)
+        if doc is None or doc is not self._data[index]:
+            doc = self._prop._embed_class._view(self._data[index], self, index)
+            self._data[index] = doc
+            self._docs[index] = doc
+        return doc
+
+    def __setitem__(self, index, doc):
+        if index < 0:
+            index += len(self._data)
+        self._data[index] = self._prop._item_for_mongo(doc)
+        self._docs.pop(index, None)
+        self._mark_changed(index)
+
+    def __delitem__(self, index):
+        del self._data[index]
+        self._docs = {}
+        self._rewrite = True
+        self._owner._mark_changed(self._prop._field_name)
+
+    def __eq__(self, l):
+        if isinstance(l, _EmbedDocumentList):
+            return self._data == l._data
+        return self._data == l
+
+    def __ne__(self, l):
+        return not self.__eq__(l)
+
+    def append(self, doc):
+        self._data.append(self._prop._item_for_mongo(doc))
+        self._appended += 1
+        self._owner._mark_changed(self._prop._field_name)
+
+    def extend(self, docs):
+        [self.append(doc) for doc in docs]
+
+    def pop(self, index=-1):
+        doc = self[index]
+        del self[index]
+        return doc
+
+    def _mark_changed(self, index):
+        self._changed.add(index)
+        self._owner._mark_changed(self._prop._field_name)
+
+    def _stored_index(self, index):
+        # the position in the stored array of an element of a window
+        if not self._windowed:
+            return index
+        if self._offset is None or index >= self._window_size:
+            raise ValidationError('%s is loaded with a window, the position '
+                'of element %d in the stored list is unknown' % (
+                self._prop._field_name, index))
+        return self._offset + index
+
+    def _changed_indexes(self):
+        if self._rewrite:
+            return range(len(self._data))
+        appended = range(len(self._data) - self._appended, len(self._data))
+        return sorted(self._changed.union(appended))
+
+    def _changed_docs(self):
+        return [self[index] for index in self._changed_indexes()]
+
+    def validate(self):
+        [doc.validate() for doc in self._changed_docs()]
+
+    def save(self, **kw):
+        """Writes the changed and appended elements only, with positional
+        `$set` and `$push` updates.
+        """
+        owner = self._owner
+        if owner._id is None or self._rewrite:
+            owner.save(**kw)
+            return
+
+        [doc.save() for doc in self._changed_docs()]
+        field = self._prop._field_name
+        spec = { '_id': owner._id }
+        pushed = len(self._data) - self._appended
+        changed = [i for i in sorted(self._changed) if i < pushed]
+        if changed:
+            owner.m.collection.update(spec, { '$set': dict(('%s.%d' % (field,
+                self._stored_index(i)), self._data[i]) for i in changed) }, **kw)
+        if self._appended:
+            owner.m.collection.update(spec, { '$push': { field: {
+                '$each': self._data[pushed:] } } }, **kw)
+        self._reset()
+
+
+class _GridFile(object):
+    """A file in GridFS, looked up on first use, read chunk by chunk
+    """
+    def __init__(self, fs, file_id):
+        self.file_id = file_id
+        self._fs = fs
+        self._grid_out = None
+
+    def __repr__(self):
+        return '<GridFile %s>' % self.file_id
+
+    @property
+    def _file(self):
+        if self._grid_out is None:
+            self._grid_out = self._fs.get(self.file_id)
+        return self._grid_out
+
+    def __getattr__(self, name):
+        # length, content_type, md5, upload_date...
+        return getattr(self._file, name)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def read_range(self, start, length):
+        """Returns `length` bytes from `start` on, only the chunks holding
+        them are fetched
+        """
+        self._file.seek(start)
+        return self._file.read(length)
+
+    def seek(self, pos, whence=0):
+        self._file.seek(pos, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def __iter__(self):
+        self._file.seek(0)
+        while True:
+            data = self._file.read(self._file.chunk_size)
+            if not data:
+                break
+            yield data
+
+
 class _AttrList(object):
     def __init__(self, l, value_type):
         self._data = l
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
+
+
+from pymongo import ASCENDING, DESCENDING
+
+from validator import ValidationError
+
+
+class Condition(object):
+    """A condition on one field, the result of comparing a property of a
+    document class, e.g. `Blog.views > 10`. The operand is converted with
+    `get_value_for_query` already.
+    """
+    def __init__(self, field, operator, value):
+        self.field = field
+        self.operator = operator
+        self.value = value
+
+    def __nonzero__(self):
+        raise TypeError('A condition on %s has no truth value, use it in a '
+            'query' % self.field)
+
+    def add_to(self, spec):
+        current = spec.get(self.field)
+        if self.operator is None:
+            if self.field in spec:
+                raise ValidationError('Conflicting conditions for %s' % self.field)
+            spec[self.field] = self.value
+        elif current is None:
+            spec[self.field] = { self.operator: self.value }
+        elif isinstance(current, dict) and self.operator not in current:
+            current[self.operator] = self.value
+        else:
+            raise ValidationError('Conflicting conditions for %s' % self.field)
+
+
+class Query(object):
+    """A query bound to a document class, built from conditions on its
+    properties, e.g.
+
+        Blog.m.filter(Blog.title == 'x', Blog.views > 10).order_by('-created')
+
+    Every builder method returns a new `Query`, nothing is sent to the
+    server before iterating. The spec is compiled once per query, so a
+    query kept around can be executed again without rebuilding it.
+    """
+    def __init__(self, manager, conditions=(), sort=(), skip=0, limit=0):
+        self._manager = manager
+        self._conditions = tuple(conditions)
+        self._sort = tuple(sort)
+        self._skip = skip
+        self._limit = limit
+        self._spec = None
+
+    def _clone(self, **kw):
+        args = dict(conditions=self._conditions, sort=self._sort,
+            skip=self._skip, limit=self._limit)
+        args.update(kw)
+        return Query(self._manager, **args)
+
+    def filter(self, *conditions, **fields):
+        """Adds conditions, keyword arguments are equality conditions on the
+        named properties
+        """
+        conditions = list(conditions)
+        for k, v in fields.iteritems():
+            prop = self._manager._check_field(k)
+            if prop is None or '.' in k:
+                conditions.append(Condition(k, None, v))
+            else:
+                conditions.append(prop == v)
+        for condition in conditions:
+            if not isinstance(condition, Condition):
+                raise ValidationError('%r is not a condition' % condition)
+        return self._clone(conditions=self._conditions + tuple(conditions))
+
+    def order_by(self, *fields):
+        """Sorts by the named fields, descending if prefixed with `-`
+        """
+        sort = []
+        for field in fields:
+            if field.startswith('-'):
+                sort.append((field[1:], DESCENDING))
+            else:
+                sort.append((field, ASCENDING))
+        [self._manager._check_field(k) for k, direction in sort]
+        return self._clone(sort=tuple(sort))
+
+    def skip(self, count):
+        return self._clone(skip=count)
+
+    def limit(self, count):
+        return self._clone(limit=count)
+
+    @property
+    def spec(self):
+        if self._spec is None:
+            spec = {}
+            [condition.add_to(spec) for condition in self._conditions]
+            self._spec = spec
+        return self._spec
+
+    def cursor(self):
+        """Executes the query, returning a `CursorProxy`
+        """
+        kw = dict(skip=self._skip, limit=self._limit)
+        if self._sort:
+            kw['sort'] = list(self._sort)
+        return self._manager.find(self.spec, **kw)
+
+    def __iter__(self):
+        return iter(self.cursor())
+
+    def count(self):
+        return self.cursor().count(with_limit_and_skip=True)
+
+    def first(self):
+        docs = list(self.limit(1))
+        return docs and docs[0] or None
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
@@ -19,33 +19,57 @@ class ValidationError(ValueError):
 
 
 class Validator(object):
-    pass
+    def validate_column(self, values):
+        """validates many values at once
+        """
+        for value in values:
+            self(value)
+
+
+class _SharedValidator(Validator):
+    """validators without options, every property shares one instance
+    """
+    def __new__(cls, *args, **kw):
+        if '_instance' not in cls.__dict__:
+            cls._instance = super(_SharedValidator, cls).__new__(cls)
+        return cls._instance
 
 
-class Boolean(Validator):
+class _TypeValidator(_SharedValidator):
+    types = ()
+    message = None
+
     def __call__(self, value):
-        if not isinstance(value, bool):
-            raise ValidationError('The value must be a boolean')
+        if not isinstance(value, self.types):
+            raise ValidationError(self.message)
+
+    def validate_column(self, values):
+        types = self.types
+        for value in values:
+            if not isinstance(value, types):
+                raise ValidationError(self.message)
+
+
+class Boolean(_TypeValidator):
+    types = bool
+    message = 'The value must be a boolean'
 
 
-class String(Validator):
+class String(_TypeValidator):
     """validates if the value is a string
     """
-    def __call__(self, value):
-        if not isinstance(value, basestring):
-            raise ValidationError('The value must be a string')
+    types = basestring
+    message = 'The value must be a string'
 
 
-class Integer(Validator):
-    def __call__(self, value):
-        if not isinstance(value, (int, long)):
-            raise ValidationError('The value must be a integer')
+class Integer(_TypeValidator):
+    types = (int, long)
+    message = 'The value must be a integer'
 
 
-class Float(Validator):
-    def __call__(self, value):
-        if not isinstance(value, float):
-            raise ValidationError('The value must be a float number')
+class Float(_TypeValidator):
+    types = float
+    message = 'The value must be a float number'
 
 
 class Length(Validator):
@@ -69,6 +93,12 @@ class Length(Validator):
                     self.min, self.max)
             raise ValidationError(error)
 
+    def validate_column(self, values):
+        lengths = [value and len(value) or 0 for value in values]
+        if lengths and (min(lengths) < self.min or
+                self.max != -1 and max(lengths) > self.max):
+            super(Length, self).validate_column(values)
+
 
 class NumberRange(Validator):
     """ validates that a number must be in a range from `min` to `max`
@@ -88,54 +118,63 @@ class NumberRange(Validator):
                 error = 'Number must be between %s and %s' % (self.min, self.max)
             raise ValidationError(error)
 
+    def validate_column(self, values):
+        # only look at single values when the bounds of the column fail
+        if not values:
+            return
+        if None in values or (self.min is not None and min(values) < self.min) or \
+            (self.max is not None and max(values) > self.max):
+            super(NumberRange, self).validate_column(values)
+
 
 class Regexp(Validator):
-    def __init__(self, regex, flags):
+    message = 'Invalid string value'
+
+    def __init__(self, regex, flags=0):
         if isinstance(regex, basestring):
             regex = re.compile(regex, flags)
         self.regex = regex
 
     def __call__(self, value):
         if not self.regex.match(value or u''):
-            raise ValidationError('Invalid string value')
+            raise ValidationError(self.message)
 
+    def validate_column(self, values):
+        match = self.regex.match
+        for value in values:
+            if not match(value or u''):
+                raise ValidationError(self.message)
 
-class Email(Regexp):
-    def __init__(self):
-        super(Email, self).__init__(r'^.+@[^.].*\.[a-z]{2,10}$', re.IGNORECASE)
 
-    def __call__(self, value):
-        try:
-            super(Email, self).__call__(value)
-        except ValidationError:
-            raise ValidationError('Invalid email address')
+_EMAIL_RE = re.compile(r'^.+@[^.].*\.[a-z]{2,10}$', re.IGNORECASE)
+_IP_ADDRESS_RE = re.compile(r'^([0-9]{1,3}\.){3}[0-9]{1,3}$', re.IGNORECASE)
+_URL_PATTERN = ur'^[a-z]+://([^/:]+%s|([0-9]{1,3}\.){3}[0-9]{1,3})(:[0-9]+)?(\/.*)?$'
+_URL_RE = re.compile(_URL_PATTERN % ur'\.[a-z]{2,10}', re.IGNORECASE)
+_URL_NO_TLD_RE = re.compile(_URL_PATTERN % u'', re.IGNORECASE)
 
 
-class IPAdress(Regexp):
+class Email(_SharedValidator, Regexp):
+    message = 'Invalid email address'
+
     def __init__(self):
-        super(IPAdress, self).__init__(r'^([0-9]{1,3}\.){3}[0-9]{1,3}$', re.IGNORECASE)
+        super(Email, self).__init__(_EMAIL_RE)
 
-    def __call__(self, value):
-        try:
-            super(IPAdress, self).__call__(value)
-        except ValidationError:
-            raise ValidationError('Invalid IP address')
+
+class IPAdress(_SharedValidator, Regexp):
+    message = 'Invalid IP address'
+
+    def __init__(self):
+        super(IPAdress, self).__init__(_IP_ADDRESS_RE)
 
 
 class URL(Regexp):
-    def __init__(self, require_tld=True):
-        tld_part = (require_tld and ur'\.[a-z]{2,10}' or u'')
-        regex = ur'^[a-z]+://([^/:]+%s|([0-9]{1,3}\.){3}[0-9]{1,3})(:[0-9]+)?(\/.*)?$' % tld_part
-        super(URL, self).__init__(regex, re.IGNORECASE)
+    message = 'Invalid URL'
 
-    def __call__(self, value):
-        try:
-            super(URL, self).__call__(value)
-        except ValidationError:
-            raise ValidationError('Invalid URL')
+    def __init__(self, require_tld=True):
+        super(URL, self).__init__(require_tld and _URL_RE or _URL_NO_TLD_RE)
 
 
-class ObjectIdValidator(Validator):
+class ObjectIdValidator(_SharedValidator):
     def __call__(self, value):
         try:
             ObjectId(unicode(value))
@@ -143,7 +182,7 @@ class ObjectIdValidator(Validator):
             raise ValidationError('Invalid Object ID')
 
 
-class GeoPt(Validator):
+class GeoPt(_SharedValidator):
     def __call__(self, value):
         if not isinstance(value, (tuple, list)):
             raise ValidationError('GeoPt can only hold a tuple or list of (x, y) ')
@@ -152,25 +191,24 @@ class GeoPt(Validator):
             raise ValidationError('GeoPt must have exactly two elements (x, y) ')
 
 
-class DateTime(Validator):
-    def __call__(self, value):
-        if callable(value):
-            value = value()
-        if not isinstance(value, datetime):
-            raise ValidationError('Invalid datetime type')
+class DateTime(_TypeValidator):
+    types = datetime
+    message = 'Invalid datetime type'
+
+
+# documents are recognized by the __embedded__ flag every Document class
+# has, so the document module is not imported here
 
 
-class DocumentValidator(Validator):
+class DocumentValidator(_SharedValidator):
     def __call__(self, value):
-        from document import Document
-        if not isinstance(value, Document):
+        if getattr(value, '__embedded__', None) is None:
             raise ValidationError('Invalid Document type')
 
 
-class EmbeddedDocumentValidator(Validator):
+class EmbeddedDocumentValidator(_SharedValidator):
     def __call__(self, value):
-        from document import EmbedDocument
-        if not isinstance(value, EmbedDocument):
+        if getattr(value, '__embedded__', None) is not True:
             raise ValidationError('Invalid Document type')
         if value._id is not None:
             raise ValidationError('A Embed Document should not have a ID')
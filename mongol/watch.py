@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
+
+
+import time
+
+from pymongo.cursor import Cursor
+from pymongo.timestamp import Timestamp
+
+
+# collection the resume tokens of named watches are kept in
+RESUME_TOKENS = 'mongol_resume_tokens'
+
+# the OplogReplay flag of the wire protocol, pymongo has no option for it
+_OPLOG_REPLAY = 8
+
+_OPERATIONS = {
+    'i': 'insert',
+    'u': 'update',
+    'd': 'delete',
+}
+
+
+class ChangeEvent(object):
+    """A change of a watched document.
+
+    `operation` is one of insert, update or delete, `document` the document
+    as it is after the change, None for deletes. `token` resumes a watch
+    right after this event.
+    """
+    def __init__(self, operation, document_id, document, token):
+        self.operation = operation
+        self.document_id = document_id
+        self.document = document
+        self.token = token
+
+    def __repr__(self):
+        return '<ChangeEvent %s %s>' % (self.operation, self.document_id)
+
+
+def _load_token(db, name):
+    row = db[RESUME_TOKENS].find_one({ '_id': name })
+    return row and row['token'] or None
+
+
+def _store_token(db, name, token):
+    db[RESUME_TOKENS].save({ '_id': name, 'token': token })
+
+
+class _OplogCursor(Cursor):
+    """A tailable cursor on the oplog sent with the OplogReplay flag, so the
+    server goes to the `ts` of the query instead of scanning the oplog from
+    its start.
+    """
+    def __init__(self, oplog, spec):
+        super(_OplogCursor, self).__init__(oplog, spec, tailable=True)
+
+    def _Cursor__query_options(self):
+        return Cursor._Cursor__query_options(self) | _OPLOG_REPLAY
+
+
+def _oplog_query(ns, token):
+    # OplogReplay needs a condition on ts, without a token the whole oplog
+    # is read
+    if token is None:
+        token = Timestamp(0, 0)
+    return { 'ns': ns, 'ts': { '$gt': token } }
+
+
+def _resume_token(db, oplog, resume_after=None, resume_name=None):
+    """Returns the `ts` to watch after: `resume_after`, the token stored for
+    `resume_name`, or the last entry of the oplog to watch from now on
+    """
+    token = resume_after
+    if token is None and resume_name:
+        token = _load_token(db, resume_name)
+    if token is None:
+        last = list(oplog.find().sort('$natural', -1).limit(1))
+        token = last and last[0]['ts'] or None
+    return token
+
+
+def _change_event(manager, entry, spec, fields):
+    from document import _hydrate
+    operation = _OPERATIONS.get(entry['op'])
+    if operation is None:
+        # no-ops and commands
+        return None
+    if operation == 'delete':
+        return ChangeEvent(operation, entry['o']['_id'], None, entry['ts'])
+
+    doc_cls = manager._document_class
+    if operation == 'insert' and not spec and not fields:
+        # inserts carry the whole document
+        row = entry['o']
+        if doc_cls.__inherit_enabled__ and \
+                doc_cls.__class_name__ not in row.get('_classes', ()):
+            return None
+        return ChangeEvent(operation, row['_id'], _hydrate(doc_cls, row), entry['ts'])
+
+    if operation == 'insert':
+        _id = entry['o']['_id']
+    else:
+        _id = entry['o2']['_id']
+    query = dict(spec or {})
+    query['_id'] = _id
+    kw = {}
+    if fields:
+        kw['fields'] = fields
+    document = manager.find_one(query, **kw)
+    if document is None:
+        # not matching the spec, or removed since
+        return None
+    return ChangeEvent(operation, _id, document, entry['ts'])
+
+
+def watch(manager, spec=None, fields=None, resume_after=None, resume_name=None,
+        poll_interval=1):
+    """Yields a `ChangeEvent` for every change of the documents of
+    `manager`, read by tailing the oplog of a replica set. See
+    `CollectionManager.watch`.
+    """
+    db = manager.db
+    oplog = db.connection['local']['oplog.rs']
+    token = _resume_token(db, oplog, resume_after, resume_name)
+
+    ns = '%s.%s' % (db.name, manager._collection_name)
+    while True:
+        # started over after the last entry seen
+        cursor = _OplogCursor(oplog, _oplog_query(ns, token))
+        while cursor.alive:
+            try:
+                entry = cursor.next()
+            except StopIteration:
+                time.sleep(poll_interval)
+                continue
+            token = entry['ts']
+            event = _change_event(manager, entry, spec, fields)
+            if event is not None:
+                yield event
+            # stored once the consumer asks for the next event, so an event
+            # is not lost when the consumer fails while handling it
+            if resume_name:
+                _store_token(db, resume_name, token)
+        # tailable cursors die on empty results, start over
+        time.sleep(poll_interval)
+
+
+def tail(manager, spec=None, fields=None, resume_after=None, poll_interval=1):
+    """Yields the documents of a capped collection in insertion order,
+    waiting for new ones. See `CollectionManager.tail`.
+    """
+    from document import _hydrate
+    doc_cls = manager._document_class
+    last_id = resume_after
+    while True:
+        args, kw = manager._wrap_arguments(spec or {})
+        query = dict(args[0])
+        if last_id is not None:
+            query['_id'] = { '$gt': last_id }
+        cursor = manager.collection.find(query, fields=fields, tailable=True)
+        while cursor.alive:
+            try:
+                row = cursor.next()
+            except StopIteration:
+                time.sleep(poll_interval)
+                continue
+            last_id = row['_id']
+            yield _hydrate(doc_cls, row)
+        time.sleep(poll_interval)
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
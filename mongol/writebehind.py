@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
+
+
+import atexit
+import logging
+import threading
+import time
+from copy import deepcopy
+from collections import OrderedDict
+from Queue import Full
+
+
+def _log_error(docs, error):
+    logging.error('Write behind of %d documents failed: %s', len(docs), error)
+
+
+class WriteBehindQueue(object):
+    """Writes saved documents in a background thread.
+
+    Documents of classes with `__write_behind__` are validated and get their
+    id when saved, but are written later: the queue waits `delay` seconds
+    for more saves, keeps only the latest state of a document saved again
+    meanwhile and writes new documents with one bulk insert per collection.
+
+    At most `max_size` documents are pending, saves block until there is
+    room again. Failed writes are passed to `on_error(docs, error)`. Pending
+    documents are written on `flush()`, `close()` and at exit.
+    """
+    def __init__(self, max_size=1000, delay=0.2, on_error=None):
+        self._max_size = max_size
+        self._delay = delay
+        self._on_error = on_error or _log_error
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        # batches are written one after another, so a document is never
+        # overwritten by an older state of it
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        atexit.register(self.close)
+
+    @property
+    def pending(self):
+        """The number of documents waiting to be written
+        """
+        return len(self._pending)
+
+    def put(self, doc, new=False, block=True, timeout=None):
+        """Queues the current state of `doc`, `new` if it was never written
+        """
+        key = (doc.__collection_name__, doc._id)
+        # a copy, the document may be changed again before it is written
+        entry = (doc, deepcopy(dict(doc._mongo_data())), new)
+        with self._cond:
+            if self._closed:
+                self._write([entry])
+                return
+            if key in self._pending:
+                # saved again before it was written
+                entry = (doc, entry[1], new or self._pending[key][2])
+            else:
+                deadline = timeout is not None and time.time() + timeout
+                while len(self._pending) >= self._max_size:
+                    remaining = deadline and deadline - time.time()
+                    if not block or deadline and remaining <= 0:
+                        raise Full('Write behind queue is full')
+                    self._cond.wait(remaining or None)
+            self._pending[key] = entry
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                # let more saves of the same documents come in, close()
+                # does not wait for it
+                deadline = time.time() + self._delay
+                while not self._closed and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Writes all pending documents now
+        """
+        with self._write_lock:
+            with self._cond:
+                entries = self._pending.values()
+                self._pending = OrderedDict()
+                self._cond.notify_all()
+            self._write(entries)
+
+    def _write(self, entries):
+        by_manager = {}
+        for doc, data, new in entries:
+            new_rows, rows = by_manager.setdefault(doc.m, ([], []))
+            (new_rows if new else rows).append((doc, data))
+
+        for manager, (new_rows, rows) in by_manager.iteritems():
+            manager._prepare_writes()
+            options = manager._write_options({})
+            if new_rows:
+                try:
+                    manager.collection.insert([data for doc, data in new_rows],
+                        **options)
+                except Exception, e:
+                    self._failed(new_rows, e)
+                else:
+                    [doc._written(data) for doc, data in new_rows]
+            for doc, data in rows:
+                try:
+                    manager.collection.save(data, **options)
+                except Exception, e:
+                    self._failed([(doc, data)], e)
+                else:
+                    doc._written(data)
+
+    def _failed(self, rows, error):
+        [doc._write_failed(data) for doc, data in rows]
+        self._on_error([doc for doc, data in rows], error)
+
+    def close(self):
+        """Writes the pending documents and stops the background thread,
+        documents saved afterwards are written right away
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+_default_queue = None
+_default_queue_lock = threading.Lock()
+
+
+def write_behind_queue(option):
+    """Returns the queue for a `__write_behind__` class attribute, a queue
+    or True for the default queue
+    """
+    global _default_queue
+    if isinstance(option, WriteBehindQueue):
+        return option
+    with _default_queue_lock:
+        if _default_queue is None:
+            _default_queue = WriteBehindQueue()
+    return _default_queue
+
+
+### EOF ###
+# vim:smarttab:sts=4:sw=4:et:ai:tw=80:
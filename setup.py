@@ -70,6 +70,9 @@ setup(
     install_requires = requirements,
     license = 'New BSD License',
     test_suite = 'tests',
+    entry_points = {
+        'console_scripts': ['mongol = mongol.audit:main'],
+    },
     classifiers = [
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
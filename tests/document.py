@@ -2,13 +2,28 @@
 #
 # Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
 
+import json
 import unittest
+from copy import deepcopy
+from datetime import datetime
+from itertools import islice
 
+from pymongo.dbref import DBRef
 from pymongo.objectid import ObjectId
+from pymongo.timestamp import Timestamp
 from pymongo import DESCENDING, ASCENDING
+from pymongo.errors import OperationFailure
 
 from mongol.document import Document, DocumentNotSavedError, DocumentInheritError
+from mongol.document import DocumentDefinitionError, instance_of
+from mongol.explain import summarize_plan, supporting_index
+from mongol import parallel
+from mongol.parallel import validate_many
 from mongol.property import *
+from mongol.validator import ValidationError
+from mongol.watch import RESUME_TOKENS, _OplogCursor, _oplog_query
+from mongol.watch import _resume_token, _store_token
+from mongol.writebehind import WriteBehindQueue
 from mongol.connection import db, connect
 
 
@@ -149,6 +164,20 @@ class DocumentTest(unittest.TestCase):
         self.assertEqual("gnr", person.band)
         self.assertEqual("gnr", person['band'])
 
+        # dynamic properties stay on the instance
+        self.assertFalse("band" in Person.__properties__)
+        self.assertFalse("band" in Person(name="Axl").__properties__)
+
+    def test_properties_not_shared_between_instances(self):
+        blog1 = self.Blog(title="Slash")
+        blog2 = self.Blog(title="Axl")
+        blog1.title = "Slash rocks"
+        self.assertEqual("Axl", blog2.title)
+        self.assertEqual(None, self.Blog.__properties__['title']._value)
+
+        blog1._id = ObjectId()
+        self.assertEqual(None, blog2._id)
+
     def test_access_to_inner_attributes(self):
         blog = self.Blog(title="Slash rocks", tags=['rock', 'roll'],
             author={
@@ -235,6 +264,38 @@ class DocumentTest(unittest.TestCase):
         Circle.m.drop()
         Square.m.drop()
 
+    def test_instance_of_queries(self):
+        class Shape(Document):
+            __inherit_enabled__ = True
+
+        class Rectangle(Shape): pass
+        class Circle(Shape): pass
+        class Square(Rectangle): pass
+
+        class Animal(Document):
+            __inherit_enabled__ = True
+
+        self.assertTrue(Shape.__class_registry__ is Square.__class_registry__)
+        self.assertEqual(Square, Shape.__class_registry__['Square'])
+
+        Shape().save()
+        Rectangle().save()
+        Circle().save()
+        Square().save()
+
+        self.assertEqual(['Rectangle', 'Circle', 'Square'], [obj.__class_name__
+            for obj in Shape.m.find(instance_of(Rectangle, Circle))])
+        self.assertEqual(['Rectangle', 'Square'], [obj.__class_name__
+            for obj in Rectangle.m.find(instance_of(Rectangle, Circle))])
+        self.assertEqual(['Square'], [obj.__class_name__
+            for obj in Square.m.find(instance_of(Rectangle))])
+        self.assertEqual({ '_classes': 'Square' },
+            Square.m._add_classes_spec(instance_of(Shape)))
+        self.assertEqual([{ '$match': { '_classes': { '$in': ['Rectangle'] } } }],
+            Shape.m.aggregate().match(instance_of(Rectangle)).pipeline)
+        self.assertRaises(DocumentInheritError, instance_of, Shape, Animal)
+        Shape.m.drop()
+
     def test_inheritance(self):
         class A(Document):
             __inherit_enabled__ = True
@@ -248,6 +309,579 @@ class DocumentTest(unittest.TestCase):
         self.assertEqual(A.__collection_name__, B.__collection_name__)
 
 
+    def test_atomic_updates(self):
+        class Post(Document):
+            title = StringProperty()
+            views = IntegerProperty(validators=[NumberRange(max=10)])
+            tags = ListProperty()
+
+        post = Post(title="Slash")
+        self.assertRaises(DocumentNotSavedError, post.inc, 'views')
+        post.save()
+
+        post.inc('views')
+        post.inc('views', 2)
+        post.push('tags', 'rock')
+        post.add_to_set('tags', 'rock')
+        post.add_to_set('tags', 'roll')
+        self.assertEqual(3, post.views)
+        self.assertEqual(['rock', 'roll'], post.tags)
+
+        self.assertRaises(ValidationError, post.inc, 'views', 10)
+        self.assertRaises(ValidationError, post.inc, 'title')
+        self.assertRaises(ValidationError, post.push, 'views', 1)
+        self.assertEqual(3, post.views)
+
+        stored = Post.m.find_one()
+        self.assertEqual(3, stored.views)
+        self.assertEqual(['rock', 'roll'], stored.tags)
+
+        Post(title="Axl").save()
+        Post.m.update_many({}, set={'title': u'GNR'}, inc={'views': 1}, safe=True)
+        self.assertEqual([u'GNR', u'GNR'], [p.title for p in Post.m.all()])
+        self.assertEqual([4, 1], [p.views for p in Post.m.all()])
+        self.assertRaises(ValidationError, Post.m.update_many, {}, set={'band': 1})
+        self.assertRaises(ValidationError, Post.m.update_many, {}, set={'title': 1})
+        Post.m.drop()
+
+    def test_find_one_and_update(self):
+        class Job(Document):
+            __inherit_enabled__ = True
+            state = StringProperty()
+            tries = IntegerProperty()
+
+        class MailJob(Job):
+            to = StringProperty()
+
+        MailJob(state=u'new', to=u'slash@gnr.com').save()
+
+        job = Job.m.find_one_and_update({'state': u'new'},
+            {'$set': {'state': u'running'}, '$inc': {'tries': 1}}, return_new=True)
+        self.assertTrue(isinstance(job, MailJob))
+        self.assertEqual(u'running', job.state)
+        self.assertEqual(1, job.tries)
+        self.assertEqual(None, Job.m.find_one_and_update({'state': u'new'},
+            {'$set': {'state': u'running'}}))
+        self.assertRaises(ValidationError, Job.m.find_one_and_update,
+            {}, {'$set': {'state': 1}})
+
+        job = MailJob.m.find_one_and_update({'to': u'axl@gnr.com'},
+            {'$set': {'state': u'new'}}, upsert=True, return_new=True)
+        self.assertTrue(isinstance(job, MailJob))
+        self.assertEqual(['MailJob'], [j.__class_name__ for j in
+            Job.m.find({'state': u'new'})])
+        Job.m.drop()
+
+    def test_upserts_ensure_indexes(self):
+        class Counter(Document):
+            __indexes__ = [[('name', ASCENDING)]]
+            name = StringProperty()
+            hits = IntegerProperty()
+
+        class Visit(Document):
+            __indexes__ = [[('page', ASCENDING)]]
+            page = StringProperty()
+
+        Counter.m.update_one({'name': u'home'}, inc={'hits': 1}, upsert=True,
+            safe=True)
+        self.assertTrue('name_1' in Counter.m.collection.index_information())
+        Visit.m.find_one_and_update({'page': u'/'}, {'$set': {'page': u'/'}},
+            upsert=True)
+        self.assertTrue('page_1' in Visit.m.collection.index_information())
+        Counter.m.drop()
+        Visit.m.drop()
+
+    def test_aggregate(self):
+        class Post(Document):
+            __inherit_enabled__ = True
+            author = StringProperty()
+            views = IntegerProperty()
+
+        class Video(Post):
+            length = IntegerProperty()
+
+        Post(author=u'Slash', views=3).save()
+        Post(author=u'Slash', views=4).save()
+        Post(author=u'Axl', views=1).save()
+        Video(author=u'Axl', views=10).save()
+
+        results = list(Post.m.aggregate().group('$author',
+            views={'$sum': '$views'}).sort('_id').as_objects())
+        self.assertEqual([u'Axl', u'Slash'], [r._id for r in results])
+        self.assertEqual([11, 7], [r.views for r in results])
+
+        results = list(Video.m.aggregate().group('$author',
+            views={'$sum': '$views'}))
+        self.assertEqual([{'_id': u'Axl', 'views': 10}], results)
+
+        posts = list(Post.m.aggregate().match({'author': u'Axl'}).sort('views'))
+        self.assertEqual([Post, Video], [p.__class__ for p in posts])
+
+        self.assertRaises(ValidationError, Post.m.aggregate().match, {'band': 1})
+        self.assertRaises(ValidationError, Post.m.aggregate().group, '$band')
+
+        # fields added by other stages are not checked against the properties
+        Post.m.aggregate().stage({'$addFields': {'score': '$views'}}).match(
+            {'score': {'$gt': 5}})
+        Post.m.aggregate().stage({'$lookup': {'from': 'comment',
+            'localField': '_id', 'foreignField': 'post', 'as': 'comments'}}
+            ).match({'comments.author': u'Duff'})
+        self.assertRaises(ValidationError, Post.m.aggregate().limit(1).match,
+            {'band': 1})
+        Post.m.drop()
+
+    def test_compact_document(self):
+        class Person(Document):
+            __compact__ = True
+            name = StringProperty()
+            age = IntegerProperty()
+
+        person = Person(name="Slash")
+        person.age = 45
+        self.assertFalse(hasattr(person, '__dict__'))
+        self.assertEqual("Slash", person['name'])
+        self.assertEqual(45, person.age)
+        self.assertEqual(['age', 'name'], sorted(person.keys()))
+        self.assertFalse('_id' in person)
+        # the dict itself stays empty, to_dict() gives the values
+        self.assertEqual({}, dict(person))
+        self.assertEqual({'name': "Slash", 'age': 45}, person.to_dict())
+        self.assertEqual(dict, type(person.to_dict()))
+        self.assertEqual({'name': "Slash", 'age': 45},
+            json.loads(json.dumps(person.to_dict())))
+        self.assertEqual(person.to_dict(), deepcopy(person).to_dict())
+
+        person.save()
+        self.assertTrue(isinstance(person.id, ObjectId))
+        person = Person.m.find_one({'name': "Slash"})
+        self.assertEqual(45, person.age)
+        self.assertEqual(person.__class__, Person)
+        Person.m.drop()
+
+    def test_compact_document_load(self):
+        class Person(Document):
+            __compact__ = True
+            name = StringProperty()
+
+        Person.m.collection.insert({'name': "Slash", 'band': "Guns N' Roses"})
+        person = Person.m.find_one({'name': "Slash"})
+        self.assertFalse(person.is_changed)
+        self.assertEqual("Guns N' Roses", person.to_dict()['band'])
+
+        # keys not declared on the class are written back as they are
+        person.name = "Saul"
+        person.save()
+        row = Person.m.collection.find_one({'_id': person.id})
+        self.assertEqual("Saul", row['name'])
+        self.assertEqual("Guns N' Roses", row['band'])
+        self.assertFalse(Person.m.find_one({'_id': person.id}).is_changed)
+        Person.m.drop()
+
+    def test_loaded_documents(self):
+        class Person(Document):
+            name = StringProperty()
+            age = IntegerProperty()
+
+        class Loader(Document):
+            __collection_name__ = 'person'
+            name = StringProperty()
+
+            @classmethod
+            def from_raw_data(cls, **data):
+                data['name'] = data['name'].upper()
+                return cls(**data)
+
+        self.assertTrue(Person.__loads_raw__)
+        self.assertFalse(Loader.__loads_raw__)
+
+        Person(name="Slash", age=45).save()
+        person = Person.m.find_one({'name': "Slash"})
+        self.assertEqual(person.__class__, Person)
+        self.assertEqual(45, person.age)
+        self.assertFalse(person.is_changed)
+        person.age = 46
+        self.assertTrue(person.is_changed)
+        self.assertEqual("SLASH", Loader.m.find_one().name)
+        Person.m.drop()
+
+    def test_to_json(self):
+        class Band(Document):
+            name = StringProperty()
+
+        class Person(Document):
+            name = StringProperty()
+            born = DateTimeProperty()
+            band = ReferenceProperty(Band)
+
+        Person.m.drop()
+        band = Band(name="Guns N' Roses")
+        band.save()
+        Person(name="Slash", born=datetime(1965, 7, 23), band=band).save()
+        Person(name="Axl", born=datetime(1962, 2, 6), band=band).save()
+
+        person = Person.m.find_one({'name': "Slash"})
+        data = json.loads(person.to_json())
+        self.assertEqual(unicode(person.id), data['_id'])
+        self.assertEqual("1965-07-23T00:00:00", data['born'])
+        self.assertEqual(unicode(band.id), data['band'])
+
+        data = json.loads(person.to_json(fields=['name', 'band'], expand=['band']))
+        self.assertEqual(['band', 'name'], sorted(data.keys()))
+        self.assertEqual("Guns N' Roses", data['band']['name'])
+
+        stream = Person.m.find().sort('name').to_json_stream(['name'], chunk_size=1)
+        self.assertEqual([{'name': "Axl"}, {'name': "Slash"}],
+            json.loads(''.join(stream)))
+        Person.m.drop()
+        Band.m.drop()
+
+    def test_query_builder(self):
+        class Person(Document):
+            __inherit_enabled__ = True
+            name = StringProperty()
+            age = IntegerProperty()
+
+        Person.m.drop()
+        for name, age in (("Slash", 45), ("Axl", 48), ("Duff", 46), ("Izzy", 52)):
+            Person(name=name, age=age).save()
+
+        query = Person.m.filter(Person.age > 45, Person.age < 50)
+        self.assertEqual({'age': {'$gt': 45, '$lt': 50}}, query.spec)
+        self.assertEqual(["Axl", "Duff"], [p.name for p in query.order_by('name')])
+        self.assertEqual(["Duff", "Axl"], [p.name for p in query.order_by('-name')])
+        self.assertEqual("Duff", query.filter(name="Duff").first().name)
+        self.assertEqual(2, query.count())
+        self.assertEqual(1, query.order_by('age').skip(1).limit(1).count())
+        self.assertEqual(None, query.filter(Person.name.in_(["Slash", "Izzy"])).first())
+        self.assertRaises(ValidationError, Person.m.filter, band="GNR")
+
+        # specs given to find are not changed
+        spec = {'name': "Slash"}
+        slash = Person.m.find_one(spec)
+        self.assertEqual("Slash", slash.name)
+        self.assertEqual({'name': "Slash"}, spec)
+        self.assertEqual({'_id': slash._id}, Person.m.filter(Person._id == slash._id).spec)
+        self.assertEqual("Slash", Person.m.filter(Person._id == slash._id).first().name)
+        Person.m.drop()
+
+        # properties compare by identity, conditions have no truth value
+        name = StringProperty()
+        self.assertTrue(name in [name])
+        self.assertFalse(StringProperty() in [StringProperty()])
+        self.assertRaises(TypeError, bool, Person.age == 45)
+
+        class Band(Document):
+            name = StringProperty()
+
+        class Musician(Document):
+            name = StringProperty()
+            band = ReferenceProperty(Band)
+
+        band = Band(name=u"Guns N' Roses")
+        self.assertRaises(ValidationError, lambda: Musician.band == band)
+        band.save()
+        Musician(name=u"Slash", band=band).save()
+        Musician(name=u"Dave", band=Band(name=u"Megadeth")).save()
+        spec = Musician.m.filter(Musician.band == band).spec
+        self.assertTrue(isinstance(spec['band'], DBRef))
+        self.assertEqual(band._id, spec['band'].id)
+        self.assertEqual([u"Slash"], [m.name for m in Musician.m.filter(
+            Musician.band == band)])
+        self.assertEqual(1, Musician.m.filter(Musician.band.in_([band])).count())
+        Musician.m.drop()
+        Band.m.drop()
+
+    def test_explain_and_index_audit(self):
+        class Post(Document):
+            __indexes__ = [[('author', ASCENDING), ('created', DESCENDING)]]
+            author = StringProperty()
+            slug = StringProperty(unique=True)
+            views = IntegerProperty()
+
+        self.assertEqual([('author', 1), ('created', -1)],
+            supporting_index(Post, {'author': "Slash"}, [('created', -1)]))
+        # uniqueness is checked with a query, not backed by an index
+        self.assertEqual(None, supporting_index(Post, {'slug': "x"}))
+        self.assertEqual(None, supporting_index(Post, {'views': {'$gt': 10}}))
+        self.assertEqual(None, supporting_index(Post, {}, [('views', 1)]))
+
+        Post(author="Slash", slug="slash-rocks", views=10).save()
+        Post(author="Axl", slug="axl-rocks", views=20).save()
+        summary = Post.m.find({'author': "Slash"}).explain_summary()
+        self.assertEqual('author_1_created_-1', summary['index'])
+        self.assertEqual(1, summary['returned'])
+        summary = Post.m.find({'views': 20}).explain_summary()
+        self.assertTrue(summary['collection_scan'])
+        self.assertEqual(2, summary['examined'])
+        Post.m.drop()
+
+        # geo queries use their index without an index scan
+        self.assertEqual('GeoSearchCursor', summarize_plan(
+            {'cursor': 'GeoSearchCursor', 'n': 2})['index'])
+        self.assertEqual('S2NearCursor', summarize_plan(
+            {'cursor': 'S2NearCursor', 'n': 2})['index'])
+        summary = summarize_plan({'queryPlanner': {'winningPlan':
+            {'stage': 'FETCH', 'inputStage': {'stage': 'GEO_NEAR_2DSPHERE',
+            'indexName': 'loc_2dsphere'}}}})
+        self.assertEqual('loc_2dsphere', summary['index'])
+        self.assertFalse(summary['collection_scan'])
+        self.assertTrue(summarize_plan({'cursor': 'BasicCursor'})['collection_scan'])
+
+    def test_counts(self):
+        for title in ("Slash", "Axl", "Duff"):
+            self.Blog(title=title, tags=['rock']).save()
+
+        blogs = self.Blog.m.find({'tags': 'rock'})
+        self.assertEqual(3, len(blogs))
+        self.assertEqual(3, blogs._count)
+        self.Blog(title="Izzy", tags=['rock']).save()
+        # counted once
+        self.assertEqual(3, len(blogs))
+        self.assertEqual(2, len(blogs.limit(2)))
+        self.assertEqual(2, len(blogs[2:]))
+
+        self.assertEqual(4, self.Blog.m.estimated_count())
+        self.assertEqual(4, self.Blog.m.approximate_count({'tags': 'rock'}))
+        self.assertEqual(1, self.Blog.m.approximate_count({'title': "Axl"},
+            max_time_ms=100))
+
+    def test_tail_capped_collection(self):
+        class Log(Document):
+            __collection_options__ = { 'capped': True, 'size': 100000 }
+            message = StringProperty()
+
+        for message in ("start", "running", "stop"):
+            Log(message=message).save()
+
+        logs = list(islice(Log.m.tail(), 2))
+        self.assertEqual(["start", "running"], [l.message for l in logs])
+        logs = islice(Log.m.tail(resume_after=logs[-1].id), 1)
+        self.assertEqual(["stop"], [l.message for l in logs])
+        Log.m.drop()
+
+    def test_watch_resume(self):
+        # a capped collection stands in for the oplog of a replica set
+        self.db.create_collection('oplog', capped=True, size=100000)
+        oplog = self.db['oplog']
+        for i in range(1, 4):
+            oplog.insert({ 'ts': Timestamp(i, 1), 'ns': 'mongoltest.blog' })
+
+        self.assertEqual(Timestamp(3, 1), _resume_token(self.db, oplog))
+        self.assertEqual(Timestamp(2, 1), _resume_token(self.db, oplog,
+            resume_after=Timestamp(2, 1)))
+        _store_token(self.db, 'blog-cache', Timestamp(1, 1))
+        self.assertEqual(Timestamp(1, 1), _resume_token(self.db, oplog,
+            resume_name='blog-cache'))
+
+        query = _oplog_query('mongoltest.blog', Timestamp(1, 1))
+        self.assertEqual({ 'ns': 'mongoltest.blog',
+            'ts': { '$gt': Timestamp(1, 1) } }, query)
+        self.assertEqual(Timestamp(0, 0),
+            _oplog_query('mongoltest.blog', None)['ts']['$gt'])
+        cursor = _OplogCursor(oplog, query)
+        # tailable and OplogReplay
+        self.assertEqual(2 | 8, cursor._Cursor__query_options() & (2 | 8))
+        self.assertEqual([Timestamp(2, 1), Timestamp(3, 1)],
+            [entry['ts'] for entry in cursor])
+        self.db.drop_collection('oplog')
+        self.db.drop_collection(RESUME_TOKENS)
+
+    def test_collection_options(self):
+        class Event(Document):
+            __collection_options__ = { 'capped': True, 'size': 100000, 'max': 2 }
+            name = StringProperty()
+
+        self.assertTrue(Event.m.ensure_collection())
+        self.assertFalse(Event.m.ensure_collection())
+        self.assertTrue(Event.m.collection.options()['capped'])
+        for name in ("start", "running", "stop"):
+            Event(name=name).save()
+        self.assertEqual(["running", "stop"], [e.name for e in Event.m.all()])
+
+        # created by someone else after the collection names were read
+        Event.m.db.collection_names = lambda: []
+        try:
+            self.assertFalse(Event.m.ensure_collection())
+        finally:
+            del Event.m.db.collection_names
+        Event.m.drop()
+
+        def create_capped_class_without_size():
+            class Event(Document):
+                __collection_options__ = { 'capped': True }
+        self.assertRaises(DocumentDefinitionError, create_capped_class_without_size)
+
+    def test_write_concern_and_read_preference(self):
+        class Metric(Document):
+            __write_concern__ = { 'w': 0 }
+            __read_preference__ = 'secondary'
+            name = StringProperty()
+
+        class Invoice(Document):
+            __write_concern__ = { 'w': 1, 'wtimeout': 1000 }
+            number = IntegerProperty()
+
+        self.assertEqual({ 'safe': False }, Metric.m._write_options({}))
+        self.assertEqual({ 'w': 1, 'wtimeout': 1000, 'j': True },
+            Invoice.m._write_options({ 'j': True }))
+        self.assertEqual({ 'safe': False }, Invoice.m._write_options({ 'w': 0 }))
+        self.assertEqual({ 'slave_okay': True }, Metric.m._read_options({}))
+        self.assertEqual({}, Metric.m._read_options({ 'read_preference': 'primary' }))
+        self.assertEqual({}, Invoice.m._read_options({}))
+
+        invoice = Invoice(number=1)
+        invoice.save()
+        invoice.number = 2
+        invoice.save(w=1)
+        self.assertEqual(2, Invoice.m.find_one().number)
+        invoice.remove()
+        self.assertEqual(None, Invoice.m.find_one(read_preference='secondary'))
+        Invoice.m.drop()
+
+    def test_write_behind(self):
+        errors = []
+        class Visit(Document):
+            __write_behind__ = WriteBehindQueue(delay=60,
+                on_error=lambda docs, e: errors.append(docs))
+            page = StringProperty()
+            hits = IntegerProperty()
+
+        Visit.m.drop()
+        visit = Visit(page='/', hits=1)
+        visit.save()
+        self.assertTrue(visit._id is not None)
+        self.assertFalse(visit.is_changed)
+        for hits in range(2, 5):
+            visit.hits = hits
+            visit.save()
+        Visit(page='/about', hits=1).save()
+        self.assertEqual(2, Visit.__write_behind__.pending)
+        self.assertEqual(0, Visit.m.find().count())
+
+        Visit.__write_behind__.flush()
+        self.assertEqual(0, Visit.__write_behind__.pending)
+        self.assertEqual(2, Visit.m.find().count())
+        self.assertEqual(4, Visit.m.find_one({ 'page': '/' }).hits)
+
+        Visit.__write_behind__.close()
+        visit.hits = 5
+        visit.save()
+        self.assertEqual(5, Visit.m.find_one({ 'page': '/' }).hits)
+        self.assertEqual([], errors)
+        Visit.m.drop()
+
+    def test_write_behind_failure(self):
+        errors = []
+        class Visit(Document):
+            __indexes__ = [([('page', ASCENDING)], { 'unique': True })]
+            __write_concern__ = { 'w': 1 }
+            __write_behind__ = WriteBehindQueue(delay=60,
+                on_error=lambda docs, e: errors.append(docs))
+            page = StringProperty()
+
+        Visit.m.drop()
+        Visit.m.insert_many([Visit(page='/')])
+        visit = Visit(page='/')
+        visit.save()
+        self.assertFalse(visit.is_changed)
+        Visit.__write_behind__.flush()
+        self.assertEqual([[visit]], errors)
+        # changed again, the next save writes it
+        self.assertTrue(visit.is_changed)
+
+        Visit.m.remove({ '_id': { '$ne': visit._id } })
+        visit.save()
+        Visit.__write_behind__.close()
+        self.assertEqual(visit._id, Visit.m.find_one({ 'page': '/' })._id)
+        Visit.m.drop()
+
+    def test_validate_many(self):
+        class Track(Document):
+            title = StringProperty(required=True)
+            length = IntegerProperty(validators=[NumberRange(0, 3600)])
+
+        docs = [Track(title='t%d' % i, length=i * 10) for i in range(100)]
+        docs[3].length = 4000
+        docs[42] = Track(length=1)
+        for processes in (1, 2):
+            errors = validate_many(docs, processes=processes, chunk_size=10)
+            self.assertEqual([3, 42], [i for i, e in errors])
+            self.assertTrue(isinstance(errors[1][1], ValidationError))
+            self.assertTrue('title' in str(errors[1][1]))
+
+        Track.m.drop()
+        Track.m.insert_many(docs)
+        errors = Track.m.find().validate(processes=2, chunk_size=10)
+        self.assertEqual(set([docs[3]._id, docs[42]._id]),
+            set(_id for _id, e in errors))
+        Track.m.drop()
+
+        # values set on save count as given, like save() sees them
+        class Album(Document):
+            title = StringProperty(required=True)
+            track = ReferenceProperty(Track, required=True)
+            released = DateTimeProperty(auto_now_add=True, required=True)
+
+        albums = [Album(title='a%d' % i, track=Track(title='t')) for i in range(20)]
+        albums[7] = Album(title='no track')
+        pool = None
+        for processes in (1, 2, 2):
+            errors = validate_many(albums, processes=processes, chunk_size=10)
+            self.assertEqual([7], [i for i, e in errors])
+            self.assertTrue('track' in str(errors[0][1]))
+            if processes == 2:
+                # the workers are kept for the next call
+                self.assertTrue(pool is None or pool is parallel._pool)
+                pool = parallel._pool
+
+    def test_file_property(self):
+        from StringIO import StringIO
+        class Album(Document):
+            title = StringProperty()
+            cover = FileProperty(chunk_size=1024, content_type='image/png')
+
+        Album.m.drop()
+        data = ''.join(chr(i % 256) for i in range(5000))
+        album = Album(title='Appetite for Destruction', cover=StringIO(data))
+        self.assertEqual(data, album.cover.getvalue())
+        album.save()
+        self.assertTrue(isinstance(album['cover'], ObjectId))
+
+        album = Album.m.find_one()
+        self.assertEqual(5000, album.cover.length)
+        self.assertEqual('image/png', album.cover.content_type)
+        self.assertEqual(data[2000:2100], album.cover.read_range(2000, 100))
+        self.assertEqual(data, ''.join(album.cover))
+
+        old_id = album['cover']
+        album.cover = 'new cover'
+        album.save()
+        self.assertEqual('new cover', Album.m.find_one().cover.read())
+        self.assertEqual(None, self.db['fs.files'].find_one({ '_id': old_id }))
+
+        def fail(*args, **kw):
+            raise OperationFailure('not master')
+        file_id = album['cover']
+        album.cover = 'failed cover'
+        Album.m.save = fail
+        self.assertRaises(OperationFailure, album.save)
+        del Album.m.save
+        self.assertEqual(file_id, album['cover'])
+        self.assertEqual(1, self.db['fs.files'].find().count())
+        self.assertEqual('new cover', Album.m.find_one().cover.read())
+
+        album.remove()
+        self.assertEqual(None, self.db['fs.files'].find_one({ '_id': file_id }))
+        self.assertEqual(0, self.db['fs.chunks'].find({ 'files_id': file_id }).count())
+        Album.m.drop()
+
+    def test_compact_expandable_doc(self):
+        def create_compact_expandable_class():
+            class Person(Document):
+                __compact__ = True
+                __expandable__ = True
+        self.assertRaises(DocumentDefinitionError, create_compact_expandable_class)
+
     def test_disabled_inheritance(self):
         class A(Document): pass
         def create_inherited_class():
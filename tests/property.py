@@ -3,8 +3,13 @@
 # Author: Yuanhao Li <jay_21cn [at] hotmail [dot] com>
 
 
+import json
 import unittest
-from datetime import datetime
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
 
 from mongol.document import Document, DocumentNotSavedError, DocumentInheritError
 from mongol.document import EmbedDocument
@@ -112,6 +117,20 @@ class PropertyTest(unittest.TestCase):
         person.age = -1
         self.assertRaises(ValidationError, person.validate)
 
+    def test_validate_column(self):
+        age = IntegerProperty(validators=[NumberRange(min=1, max=80)])
+        age.validate_column([1, 30, None, 80])
+        self.assertRaises(ValidationError, age.validate_column, [30, 100])
+        self.assertRaises(ValidationError, age.validate_column, [30, '40'])
+
+        email = EmailProperty()
+        email.validate_column([u'slash@gnr.com', u'axl@gnr.com'])
+        self.assertRaises(ValidationError, email.validate_column,
+            [u'slash@gnr.com', u'axl'])
+
+        # validators without options are shared between properties
+        self.assertTrue(email._validators[0] is EmailProperty()._validators[0])
+
     def test_boolean_property(self):
         class Person(Document):
             married = BooleanProperty()
@@ -153,6 +172,39 @@ class PropertyTest(unittest.TestCase):
         person.loc = [39.9074977, 116.3972282]
         person.validate()
 
+    def test_geo_queries(self):
+        class Store(Document):
+            name = StringProperty()
+            loc = GeoPtProperty()
+
+        class Shop(Document):
+            name = StringProperty()
+            loc = GeoPtProperty(geojson=True)
+
+        for doc_cls in (Store, Shop):
+            doc_cls(name=u"Beijing", loc=[116.3972282, 39.9074977]).save()
+            doc_cls(name=u"Shanghai", loc=[121.4737, 31.2304]).save()
+            doc_cls(name=u"Tianjin", loc=[117.2, 39.13]).save()
+
+            shop = doc_cls.m.find_one({'name': u"Tianjin"})
+            self.assertEqual([117.2, 39.13], list(shop.loc))
+            row = doc_cls.m.collection.find_one({'name': u"Tianjin"})
+            if doc_cls.loc.geojson:
+                self.assertEqual({'type': 'Point', 'coordinates': [117.2, 39.13]}, row['loc'])
+                self.assertTrue('loc_2dsphere' in
+                    doc_cls.m.collection.index_information())
+            else:
+                self.assertEqual([117.2, 39.13], row['loc'])
+
+            self.assertEqual([u"Tianjin", u"Beijing"], [s.name for s in
+                doc_cls.m.near('loc', (117.0, 39.0), limit=2)])
+            self.assertEqual([u"Beijing", u"Tianjin"], sorted(s.name for s in
+                doc_cls.m.within_box('loc', (115, 38), (118, 41))))
+            self.assertEqual([u"Shanghai"], [s.name for s in
+                doc_cls.m.within_polygon('loc', [(120, 30), (123, 30), (123, 32), (120, 32)])])
+            self.assertRaises(ValidationError, doc_cls.m.near, 'name', (0, 0))
+            doc_cls.m.drop()
+
     def test_datetime_property(self):
         class Person(Document):
             joined = DateTimeProperty()
@@ -167,6 +219,37 @@ class PropertyTest(unittest.TestCase):
         person.joined = '2012-12-25'
         self.assertRaises(ValidationError, person.validate)
 
+    def test_datetime_auto_now(self):
+        class Event(Document):
+            name = StringProperty()
+            created = DateTimeProperty(auto_now_add=True, required=True)
+            updated = DateTimeProperty(auto_now=True)
+            expires = DateTimeProperty(ttl=3600)
+
+        event = Event(name=u"Concert")
+        event.save()
+        created = event.created
+        self.assertTrue(isinstance(created, datetime))
+        self.assertEqual(created, event.updated)
+
+        event.name = u"Gig"
+        event.save()
+        self.assertEqual(created, event.created)
+        self.assertTrue(event.updated >= created)
+        self.assertEqual(created, Event.m.find_one().created)
+
+        indexes = Event.m.index_information()
+        self.assertEqual([3600], [v.get('expireAfterSeconds')
+            for v in indexes.values() if v['key'] == [('expires', 1)]])
+
+        buckets = list(Event.m.time_buckets('created', created,
+            created + timedelta(hours=2), timedelta(hours=1)))
+        self.assertEqual(2, len(buckets))
+        self.assertEqual([1, 0], [len(cursor) for start, cursor in buckets])
+        self.assertRaises(ValidationError, Event.m.find_in_range, 'name',
+            created, created)
+        Event.m.drop()
+
     def test_referenced_doc(self):
         class Doc2(Document):
             name = StringProperty()
@@ -218,6 +301,86 @@ class PropertyTest(unittest.TestCase):
         Doc1.m.drop()
         Doc2.m.drop()
 
+    def test_referenced_ids_and_batched_resolution(self):
+        class Band(Document):
+            name = StringProperty()
+
+        class Musician(Document):
+            name = StringProperty()
+            band = ReferenceProperty(Band, dbref=False)
+            bands = ReferenceListProperty(Band, dbref=False)
+
+        gnr = Band(name=u"Guns N' Roses")
+        snakepit = Band(name=u"Slash's Snakepit")
+        Musician(name=u"Slash", band=gnr, bands=[gnr, snakepit]).save()
+        Musician(name=u"Axl", band=gnr).save()
+
+        raw = Musician.m.collection.find_one({'name': u"Slash"})
+        self.assertEqual(gnr.id, raw['band'])
+        self.assertEqual([gnr.id, snakepit.id], raw['bands'])
+
+        musicians = list(Musician.m.all())
+        Musician.m.resolve_references(musicians)
+        self.assertEqual([u"Guns N' Roses", u"Guns N' Roses"],
+            [m.band.name for m in musicians])
+        self.assertTrue(musicians[0].band is musicians[1].band)
+        self.assertEqual([u"Guns N' Roses", u"Slash's Snakepit"],
+            [b.name for b in musicians[0].bands])
+        self.assertEqual([], musicians[1].bands)
+
+        musician = Musician.m.find_one({'name': u"Axl"})
+        self.assertEqual(u"Guns N' Roses", musician.band.name)
+
+        Band.m.drop()
+        Musician.m.drop()
+
+    def test_save_reference_graph(self):
+        class Band(Document):
+            __indexes__ = [([('name', ASCENDING)], { 'unique': True })]
+            name = StringProperty()
+            info = DictProperty()
+
+        class Musician(Document):
+            name = StringProperty(unique=True)
+            band = ReferenceProperty(Band, dbref=False)
+            bands = ReferenceListProperty(Band, dbref=False)
+
+        gnr = Band(name=u"Guns N' Roses", info={ 'formed': 1985 })
+        snakepit = Band(name=u"Slash's Snakepit")
+        slash = Musician(name=u"Slash", band=gnr, bands=[gnr, snakepit])
+        slash.save()
+
+        self.assertTrue(gnr.id is not None)
+        self.assertFalse(gnr.is_changed)
+        self.assertEqual(2, Band.m.find().count())
+        self.assertEqual(gnr.id, Musician.m.collection.find_one(
+            {'name': u"Slash"})['band'])
+
+        # saving again does not trip over the unique check
+        slash.name = u"Saul Hudson"
+        slash.save()
+        self.assertEqual(u"Saul Hudson", Musician.m.find_one({'_id': slash.id}).name)
+
+        # dicts changed in place are written too
+        slash = Musician.m.find_one({'_id': slash.id})
+        slash.band.info['formed'] = 1986
+        slash.save()
+        self.assertEqual(1986, Band.m.find_one({'_id': gnr.id}).info['formed'])
+
+        # documents of a failed insert are saved again with their parent
+        Band.m.collection.insert({'name': u"Velvet Revolver"})
+        velvet = Band(name=u"Velvet Revolver")
+        duff = Musician(name=u"Duff", band=velvet)
+        self.assertRaises(OperationFailure, duff.save, safe=True)
+        self.assertTrue(velvet.is_changed)
+        Band.m.collection.remove({'name': u"Velvet Revolver"})
+        duff.save(safe=True)
+        self.assertEqual(velvet.id, Band.m.find_one({'name': u"Velvet Revolver"}).id)
+        self.assertEqual(velvet.id, Musician.m.collection.find_one(
+            {'name': u"Duff"})['band'])
+        Band.m.drop()
+        Musician.m.drop()
+
     def test_embed_doc(self):
         class Doc2(EmbedDocument):
             name = StringProperty()
@@ -264,6 +427,163 @@ class PropertyTest(unittest.TestCase):
 
         Doc.m.drop()
 
+    def test_nested_compact_embed_doc(self):
+        class City(EmbedDocument):
+            __compact__ = True
+            name = StringProperty()
+
+        class Address(EmbedDocument):
+            street = StringProperty()
+            city = EmbedDocumentProperty(City)
+
+        class Person(Document):
+            name = StringProperty()
+            address = EmbedDocumentProperty(Address)
+            addresses = EmbedDocumentListProperty(Address)
+
+        self.assertTrue(Address.__compact_embeds__)
+        self.assertTrue(Person.__compact_embeds__)
+
+        person = Person(name=u"Slash",
+            address=Address(street=u"Sunset Blvd", city=City(name=u"LA")),
+            addresses=[Address(street=u"Abbey Road", city=City(name=u"London"))])
+        person.save()
+
+        row = Person.m.collection.find_one()
+        self.assertEqual({'name': u"LA"}, row['address']['city'])
+        self.assertEqual({'name': u"London"}, row['addresses'][0]['city'])
+        person = Person.m.find_one()
+        self.assertEqual(u"LA", person.address.city.name)
+        self.assertEqual(u"London", person.addresses[0].city.name)
+        Person.m.drop()
+
+    def test_embed_doc_writes_reach_parent(self):
+        class Address(EmbedDocument):
+            city = StringProperty()
+
+        class Person(Document):
+            name = StringProperty()
+            address = EmbedDocumentProperty(Address)
+
+        person = Person(name=u"Slash", address=Address(city=u"London"))
+        person.save()
+        self.assertFalse(person.is_changed)
+
+        person = Person.m.find_one()
+        address = person.address
+        self.assertTrue(address is person.address)
+        self.assertFalse(person.is_changed)
+
+        address.city = u"Los Angeles"
+        self.assertTrue(person.is_changed)
+        self.assertEqual(u"Los Angeles", person['address']['city'])
+        person.save()
+        self.assertFalse(person.is_changed)
+
+        self.assertEqual(u"Los Angeles", Person.m.find_one().address.city)
+        self.assertEqual(None, Person(name=u"Axl").address)
+
+        # plain dict consumers see the values
+        address = Person.m.find_one().address
+        self.assertEqual({ 'city': u"Los Angeles" }, dict(address))
+        self.assertEqual('{"city": "Los Angeles"}', json.dumps(address))
+        copied = deepcopy(address)
+        self.assertTrue(isinstance(copied, Address))
+        self.assertEqual(u"Los Angeles", copied.city)
+        copied.city = u"Paris"
+        self.assertEqual(u"Los Angeles", address.city)
+        self.assertEqual(1, Person.m.find({ 'address': address }).count())
+        Person.m.drop()
+
+    def test_embed_doc_list(self):
+        class Comment(EmbedDocument):
+            author = StringProperty(required=True)
+            body = StringProperty()
+
+        class Post(Document):
+            title = StringProperty()
+            comments = EmbedDocumentListProperty(Comment)
+
+        post = Post(title=u"GNR", comments=[Comment(author=u"Slash"),
+            Comment(author=u"Axl")])
+        post.save()
+
+        post = Post.m.find_one()
+        self.assertEqual(2, len(post.comments))
+        self.assertEqual(u"Axl", post.comments[1].author)
+
+        post.comments[0].body = u"Rocks"
+        post.comments.append(Comment(author=u"Duff"))
+        post.comments.save()
+
+        post = Post.m.find_one()
+        self.assertEqual([u"Slash", u"Axl", u"Duff"], [c.author for c in post.comments])
+        self.assertEqual(u"Rocks", post.comments[0].body)
+
+        post.comments[1].author = None
+        self.assertRaises(ValidationError, post.validate)
+
+        post = Post.m.find_one(fields=Post.comments.slice(-1))
+        self.assertEqual([u"Duff"], [c.author for c in post.comments])
+        post = Post.m.find_one(fields=Post.comments.elem_match({'author': u"Axl"}))
+        self.assertEqual([u"Axl"], [c.author for c in post.comments])
+        self.assertRaises(ValidationError, Post.comments.elem_match, {'band': 1})
+
+        # a window from the end has no known position in the stored list
+        post = Post.m.find_one(fields=Post.comments.slice(-1))
+        post.comments[0].body = u"Last"
+        self.assertRaises(ValidationError, post.comments.save)
+        self.assertRaises(ValidationError, post.save)
+
+        post = Post.m.find_one(fields=Post.comments.slice(1, 1))
+        post.comments[0].body = u"Second"
+        post.comments.save()
+        post = Post.m.find_one()
+        self.assertEqual([u"Slash", u"Axl", u"Duff"], [c.author for c in post.comments])
+        self.assertEqual(u"Rocks", post.comments[0].body)
+        self.assertEqual(u"Second", post.comments[1].body)
+        Post.m.drop()
+
+
+    def test_binary(self):
+        class Page(Document):
+            url = StringProperty()
+            html = BinaryProperty(compress='zlib', max_size=10000)
+            favicon = BinaryProperty()
+
+        Page.m.drop()
+        html = '<html>' + 'Welcome to the jungle ' * 100 + '</html>'
+        page = Page(url=u'http://gnr.com', html=html, favicon='\x00\x01')
+        self.assertTrue(isinstance(page.html, memoryview))
+        self.assertEqual(html, page.html.tobytes())
+        self.assertTrue(page.html is page.html)
+        self.assertTrue(len(dict.get(page, 'html')) < len(html))
+        page.save()
+
+        page = Page.m.find_one()
+        self.assertEqual(html, page.html.tobytes())
+        self.assertEqual('\x00\x01', page.favicon.tobytes())
+        self.assertEqual('jungle', page.html[21:27].tobytes())
+
+        stats = Page.html.stats()
+        self.assertEqual(1, stats['values'])
+        self.assertEqual(len(html), stats['raw_bytes'])
+        self.assertTrue(stats['ratio'] < 0.1)
+        # conversions of query values are not counted
+        Page.m.find_one({'favicon': Page.favicon.get_value_for_mongo('\x00\x01')})
+        self.assertEqual(1, Page.favicon.stats()['values'])
+        self.assertEqual(0, Page.html.stats({'url': u'http://vr.com'})['values'])
+
+        data = json.loads(page.to_json())
+        self.assertEqual(html, data['html'].decode('base64'))
+        self.assertFalse('\n' in data['html'])
+
+        def set_html(value):
+            page.html = value
+        self.assertRaises(ValidationError, set_html, 'x' * 10001)
+        self.assertRaises(ValidationError, set_html, u'unicode')
+        self.assertRaises(ValueError, BinaryProperty, compress='lz4')
+        Page.m.drop()
 
 if __name__ == "__main__":
     unittest.main()